@@ -7,10 +7,13 @@ import shutil
 from zipfile import ZipFile, ZIP_LZMA
 
 from compiler_blog import compile_all_blog_posts, compile_blog_post
-from compiler_core import clean_compiler_output
+from compiler_core import clean_compiler_output, remove_orphaned_resources, SymbolTable
 from compiler_graph import compile_all_graph_pages
+from compiler_manifest import build_manifest
+from compiler_watch import watch_posts
+from exporter import export_static_site, precompile_sitemap
 from exceptions import BlogManagerException, PostNotFoundException, CancelledException
-from misc import read_file, done
+from misc import read_file, done, bump_content_generation
 
 if os.name != "nt":
     import readline
@@ -19,6 +22,7 @@ if os.name != "nt":
 from functools import partial
 from typing import Optional, Callable
 
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 try:
@@ -27,7 +31,8 @@ except ModuleNotFoundError:
     # Windows things...
     pass
 
-from sqlbase import db, Author, BlogPost, Tag, TagAssociation, Friend, Nameable, ReferrerHostname, Comment
+from sqlbase import db, Author, BlogPost, Tag, TagAssociation, Friend, Nameable, ReferrerHostname, Comment, \
+    prune_search_index
 
 BACKUP_FILE_NAME = "backup.zip"
 BANNER = "-=[ Blog Manager ]=-\n"
@@ -36,6 +41,10 @@ ERROR_ATTRIBUTE_DOES_NOT_EXIST = "Attribute does not exist!"
 
 selected_object: Optional[Nameable] = None
 
+# Let the running blog know that it should re-render its pages.
+# The cached pages are already removed on commit, see shared_cache.
+event.listen(db, "after_commit", lambda _session: bump_content_generation())
+
 
 # Parse expressions like "1 - 5, 8, 10" into [1, 2, 3, 4, 5, 8, 10]
 def parse_range_expression(exp: str) -> set:
@@ -394,6 +403,9 @@ def make_backup() -> None:
         os.remove(BACKUP_FILE_NAME)
 
     print("Backing up...")
+
+    # Move everything from the write-ahead log into the database file itself.
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
     with ZipFile(BACKUP_FILE_NAME, "w", ZIP_LZMA) as f:
         zip_dir("blogposts", f)
         f.write("blog.db")
@@ -403,13 +415,30 @@ def make_backup() -> None:
 
 
 def compile_post_by_id() -> None:
-    for_blog_posts(compile_blog_post)
+    symbol_table = SymbolTable()
+    for_blog_posts(partial(compile_blog_post, symbol_table=symbol_table))
+    build_manifest.save()
+    symbol_table.report_missing_references()
+    precompile_sitemap()
 
 
 def recompile_all_posts() -> None:
+    # Only posts which changed since the last compile (see the build manifest) are rebuilt.
+    build_manifest.prune({blog_post.id for blog_post in db.query(BlogPost)})
+    prune_search_index()
+
+    # One symbol table for both, so that all missing references are reported together at the end.
+    symbol_table = SymbolTable()
+    compile_all_blog_posts(symbol_table=symbol_table)
+    compile_all_graph_pages(symbol_table=symbol_table)
+    precompile_sitemap()
+    symbol_table.report_missing_references()
+
+
+def recompile_all_posts_from_scratch() -> None:
     clean_compiler_output()
-    compile_all_blog_posts()
-    compile_all_graph_pages()
+    build_manifest.clear()
+    recompile_all_posts()
 
 
 def spellcheck() -> None:
@@ -491,9 +520,15 @@ def main() -> None:
 
         "compile": {
             "all": recompile_all_posts,
+            "full": recompile_all_posts_from_scratch,
             "id": compile_post_by_id,
             "graph": compile_all_graph_pages,
             "blog": compile_all_blog_posts,
+            "watch": watch_posts,
+        },
+
+        "export": {
+            "static": export_static_site,
         },
 
         "get": {None: get_selected_object_attribute},
@@ -505,6 +540,7 @@ def main() -> None:
         "save": {None: save_changes},
         "exit": {None: exit_program},
 
+        "gc": {None: remove_orphaned_resources},
         "spellcheck": {None: spellcheck},
         "backup": {None: make_backup},
         "clear": {None: lambda: os.system("cls") if os.name == "nt" else os.system("clear")},
@@ -1,25 +1,51 @@
+import functools
 import os
 import random
+import time
 from datetime import datetime
-from typing import Callable
+from typing import Callable, Optional, Tuple
 from urllib.parse import urlparse
 
 from flask import current_app
-from flask import render_template, request, send_from_directory, Response, url_for
+from flask import render_template, request, Response, url_for, make_response, session, jsonify
 from flask.blueprints import Blueprint
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup, escape
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import abort
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import redirect, secure_filename
 
 from forms import CommentForm
+from hit_counter import HitCounter
+from referrer_recorder import ReferrerRecorder
 from main import cache
-from misc import FileCache, static_vars, IPTracker, in_res_path, hash_string
-from readable_queries import get_all_visible_blog_posts
-from sitemap import generate_sitemap
-from sqlbase import db, BlogPost, Author, Tag, Friend, ReferrerHostname
+from misc import FileCache, static_vars, IPTracker, in_res_path, hash_string, bump_content_generation, \
+    get_content_generation
+from precompressed import send_precompressed
+from readable_queries import get_newest_visible_blog_posts, get_non_empty_section_tags, get_tag_with_blog_posts, \
+    get_author_with_blog_posts, get_blog_post_with_relations, get_newest_visible_blog_posts_with_files, \
+    search_visible_blog_posts, SEARCH_MATCH_START, SEARCH_MATCH_END, get_blog_post_page, count_visible_blog_posts, \
+    count_visible_file_resources, format_page_cursor, parse_page_cursor
+from shared_cache import tag_page, get_listing_tags, post_tag, author_tag, tag_tag, SharedCache
+from sitemap import write_sitemap, get_base_url, get_sitemap_file_name, SITEMAP_PATH, SITEMAP_INDEX_FILE_NAME
+from sqlbase import db, engine, BlogPost, Friend, ReferrerHostname
 
 bp = Blueprint("home", __name__, static_folder="../static")
 
+# Parts of the blog post page which differ per request, filled into the cached page.
+HITS_PLACEHOLDER = Markup("<!-- fn:hits -->")
+HIDDEN_FIELDS_PLACEHOLDER = Markup("<!-- fn:hidden-fields -->")
+
+SEARCH_RESULTS_PER_PAGE = 20
+
+# Length of the hashes used as ETags.
+ETAG_LENGTH = 16
+
+# The listings show this many posts per page.
+POSTS_PER_PAGE = 50
+FILE_POSTS_PER_PAGE = 20
+
 
 def try_with_integrity_protection(statement: Callable) -> None:
     try:
@@ -29,16 +55,70 @@ def try_with_integrity_protection(statement: Callable) -> None:
         db.rollback()  # Duplicate.
 
 
+def respond_conditionally(etag: str, last_modified: Optional[datetime], render: Callable) -> Response:
+    """Answer with 304 if the client already has this version of the page, and only render it otherwise."""
+    if request.method in ["GET", "HEAD"] and \
+            not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif (response := make_response(render())).status_code != 200:
+        return response
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    # Clients may keep the page, but have to ask if it changed before showing it again.
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_on_content(route: Callable) -> Callable:
+    """For pages which only change when the blog manager or a comment bumps the content generation."""
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs) -> Response:
+        generation = get_content_generation()
+        last_modified = datetime.utcfromtimestamp(generation / 1e9) if generation else None
+        return respond_conditionally(hash_string(str(generation), ETAG_LENGTH), last_modified,
+                                     lambda: route(*args, **kwargs))
+
+    return wrapper
+
+
+def get_form_token_validator() -> str:
+    # A page answered with 304 keeps the comment form token it was rendered with, and these
+    # expire (after an hour by default). Changing this every half of that keeps revalidated pages postable.
+    time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    period = int(time.time()) // (time_limit // 2) if time_limit else 0
+    return f"{session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))}-{period}"
+
+
+@bp.before_request
+@static_vars(generation=get_content_generation())
+def drop_outdated_pages() -> None:
+    # Changes only remove the affected pages from the shared cache. Other backends, e.g. one "simple"
+    # cache per process, are emptied whenever the content generation changed.
+    if isinstance(cache.cache, SharedCache):
+        return
+
+    if (generation := get_content_generation()) != drop_outdated_pages.generation:
+        drop_outdated_pages.generation = generation
+        cache.clear()
+
+
 @bp.before_request
+@static_vars(referrer_recorder=ReferrerRecorder(engine))
 def register_referrer() -> None:
     # Save only the hostname (more could be dangerous privacy-wise) of the referrer url.
+    # Known hostnames cost nothing, new ones are written in the background.
     if raw_hostname := urlparse(request.referrer).hostname:
-        try_with_integrity_protection(lambda: db.add(ReferrerHostname(raw_hostname)))
+        register_referrer.referrer_recorder.record(raw_hostname)
 
 
 @bp.route("/backlinks")
-@cache.cached()
+@cache.cached(timeout=300)
 def route_backlinks() -> Response:
+    # New referrers are stored in the background, so this page just expires.
+    tag_page("referrers")
     return render_template("backlinks.html", title="Backlinks", return_to_root=True,
                            hostnames=db.query(ReferrerHostname).all())
 
@@ -46,16 +126,22 @@ def route_backlinks() -> Response:
 @bp.route("/robots.txt")
 @bp.route("/favicon.ico")
 def static_from_root() -> Response:
-    return send_from_directory(current_app.static_folder, request.path[1:])
+    return send_precompressed(current_app.static_folder, request.path[1:])
 
 
 @bp.route("/sitemap.xml")
-@cache.cached()
-def sitemap_route() -> Response:
-    return Response(generate_sitemap(), mimetype="application/xml")
+@bp.route("/sitemap-<int:shard>.xml")
+def sitemap_route(shard: int = None) -> Response:
+    # The sitemap is written when compiling, this is only a fallback.
+    if not os.path.exists(os.path.join(SITEMAP_PATH, SITEMAP_INDEX_FILE_NAME)):
+        write_sitemap(get_base_url())
+
+    file_name = SITEMAP_INDEX_FILE_NAME if shard is None else get_sitemap_file_name(shard)
+    return send_precompressed(SITEMAP_PATH, file_name, mimetype="application/xml")
 
 
 @bp.route("/")
+@conditional_on_content
 @cache.cached()
 @static_vars(quotes=[
     # Caching these doesn't matter, its okay if these only change occasionally.
@@ -81,19 +167,41 @@ def route_root() -> any:
     quote = random.choice(route_root.quotes)
 
     friends = db.query(Friend).all()
-    category_tags = [tag for tag in db.query(Tag).filter_by(main_section=True) if tag.blog_posts]
-    blog_posts = get_all_visible_blog_posts().order_by(BlogPost.timestamp.desc()).limit(5).all()
+    category_tags = get_non_empty_section_tags().all()
+    blog_posts = get_newest_visible_blog_posts().limit(5).all()
+    tag_page("tags", "friends", *get_listing_tags(blog_posts))
 
     return render_template("home.html", title="Root", header="Welcome to the Flesh-Network.", sub_header=quote,
                            blog_posts=blog_posts, friends=friends, category_tags=category_tags,
                            quote=quote)
 
 
+def get_listing_page(query: any, count: int, direction: str, raw_cursor: Optional[str]) -> dict:
+    """One page of a newest first listing, as template arguments, along with the cursors of the neighbouring pages."""
+    try:
+        cursor = parse_page_cursor(raw_cursor) if raw_cursor else None
+    except ValueError:
+        abort(404)
+
+    newer = direction == "newer"
+    blog_posts, has_more = get_blog_post_page(query, cursor, newer, count)
+    has_newer, has_older = (has_more, True) if newer else (cursor is not None, has_more)
+    return {
+        "blog_posts": blog_posts,
+        "newer_cursor": format_page_cursor(blog_posts[0]) if blog_posts and has_newer else None,
+        "older_cursor": format_page_cursor(blog_posts[-1]) if blog_posts and has_older else None,
+    }
+
+
 @bp.route("/blogposts/")
-def route_posts() -> any:
-    blog_posts = get_all_visible_blog_posts().order_by(BlogPost.timestamp.desc()).all()
+@bp.route("/blogposts/<any(older, newer):direction>/<string:cursor>/")
+@conditional_on_content
+@cache.cached()
+def route_posts(direction: str = "older", cursor: str = None) -> any:
+    listing_page = get_listing_page(get_newest_visible_blog_posts(), POSTS_PER_PAGE, direction, cursor)
+    tag_page(*get_listing_tags(listing_page["blog_posts"]))
     return render_template("posts.html", title="All Writings", return_to_root=True,
-                           blog_posts=blog_posts)
+                           post_count=count_visible_blog_posts(), **listing_page)
 
 
 @bp.route("/blogposts/<int:blog_post_id>/survey", methods=["POST"])
@@ -122,67 +230,161 @@ def route_survey_submit(blog_post_id: int) -> any:
                            blog_post=blog_post, hashed_ip=hashed_ip)
 
 
-@bp.route("/blogposts/<int:blog_post_id>/", methods=["GET", "POST"])
-@bp.route("/blogposts/<int:blog_post_id>/<string:_name>/", methods=["GET", "POST"])
-@static_vars(file_cache=FileCache(), ip_tracker=IPTracker())
-def route_blog_post(blog_post_id: int, _name: str = "") -> any:
-    if (blog_post := db.query(BlogPost).get(blog_post_id)) is None:
-        abort(404)
-
-    # Comment posting
-    if (form := CommentForm()).validate_on_submit() and blog_post.allow_comments:
-        comment = form.to_database_object()
-        try_with_integrity_protection(lambda: blog_post.comments.append(comment))
-        return redirect(url_for("home.route_blog_post", blog_post_id=blog_post_id, _name=_name))
-
+def render_blog_post_page(blog_post: BlogPost) -> str:
     # The cache object is a function-static (like in C) variable
     blog_post_content = route_blog_post.file_cache.get_contents(blog_post.html_path)
 
-    # Flush the ip tracker, and then, check if we should count this request as a true hit.
-    route_blog_post.ip_tracker.remove_expired()
-    if route_blog_post.ip_tracker.should_count_request(request.remote_addr, blog_post_id):
-        blog_post.hits += 1
-        db.commit()
-
     # Select a random image to be served for opengraph embeds.
     image_resources = [fr for fr in blog_post.file_resources if fr.is_thumbnail]
     open_graph_image = in_res_path(random.choice(image_resources).name) if image_resources else None
 
     return render_template("blog_post.html", title=blog_post.name, return_to_root=True,
                            blog_post=blog_post, blog_post_content=blog_post_content,
-                           form=CommentForm(), open_graph_image=open_graph_image)
+                           form=CommentForm(), open_graph_image=open_graph_image,
+                           hits=HITS_PLACEHOLDER, hidden_fields=HIDDEN_FIELDS_PLACEHOLDER)
+
+
+@static_vars(ip_tracker=IPTracker(), hit_counter=HitCounter(engine))
+def count_hit(blog_post_id: int) -> int:
+    """Count the request as a hit of the post if it is a true one, returns the hits of the post."""
+    # Flush the ip tracker, and then, check if we should count this request as a true hit.
+    count_hit.ip_tracker.remove_expired()
+    if current_app.config.get("COUNT_HITS", True) and \
+            count_hit.ip_tracker.should_count_request(request.remote_addr, blog_post_id):
+        count_hit.hit_counter.count(blog_post_id)
+
+    # Hits are written in batches in the background, so this count might lag a few seconds behind other workers.
+    return count_hit.hit_counter.get_hits(blog_post_id)
+
+
+def format_hits(hits: int) -> str:
+    return f"{hits} {'time' if hits == 1 else 'times'}"
+
+
+@bp.route("/blogposts/<int:blog_post_id>/", methods=["GET", "POST"])
+@bp.route("/blogposts/<int:blog_post_id>/<string:_name>/", methods=["GET", "POST"])
+@static_vars(file_cache=FileCache())
+def route_blog_post(blog_post_id: int, _name: str = "") -> any:
+    # Rendered pages are kept until a comment is posted or the blog manager changes something
+    # shown on them. Only plain GETs are cached, as a failed POST fills the form with user input.
+    cache_key = "blog_post/" + request.base_url
+    if request.method != "GET" or (cached_page := cache.get(cache_key)) is None:
+        if (blog_post := get_blog_post_with_relations(blog_post_id)) is None:
+            abort(404)
+
+        # Comment posting
+        if (form := CommentForm()).validate_on_submit() and blog_post.allow_comments:
+            comment = form.to_database_object()
+            try_with_integrity_protection(lambda: blog_post.comments.append(comment))
+            bump_content_generation()
+            return redirect(url_for("home.route_blog_post", blog_post_id=blog_post_id, _name=_name))
+
+        page = render_blog_post_page(blog_post)
+        cached_page = page, hash_string(page, ETAG_LENGTH)
+
+        # Don't let arbitrary names fill up the cache.
+        if request.method == "GET" and _name in ["", blog_post.slug]:
+            tag_page(post_tag(blog_post.id), author_tag(blog_post.author_id),
+                     *[tag_tag(tag.id) for tag in blog_post.tags])
+            cache.set(cache_key, cached_page)
+
+    page, page_hash = cached_page
+    if current_app.config.get("STATIC_EXPORT"):
+        # Exported pages are served as files, base.js loads the hits and the form token from route_blog_post_live.
+        form = CommentForm()
+        live_url = url_for("home.route_blog_post_live", blog_post_id=blog_post_id)
+        return (page.replace(HITS_PLACEHOLDER, Markup(f"<span id=\"live_hits\" data-url=\"{live_url}\"></span>"))
+                .replace(HIDDEN_FIELDS_PLACEHOLDER, form.hidden_tag(form.hidden_password) +
+                         Markup("<input id=\"csrf_token\" name=\"csrf_token\" type=\"hidden\" value=\"\">")))
+
+    hits = count_hit(blog_post_id)
+
+    # The page stays the same as long as its rendered parts, the hits and the form token do.
+    etag = hash_string(f"{page_hash}-{hits}-{get_form_token_validator()}", ETAG_LENGTH)
+    return respond_conditionally(etag, None, lambda: page
+                                 .replace(HITS_PLACEHOLDER, format_hits(hits))
+                                 .replace(HIDDEN_FIELDS_PLACEHOLDER, CommentForm().hidden_tag()))
+
+
+@bp.route("/blogposts/<int:blog_post_id>/live")
+def route_blog_post_live(blog_post_id: int) -> Response:
+    """The parts of a post page which differ per visit, for exported pages. Loading them counts the visit."""
+    if db.query(BlogPost.id).filter(BlogPost.id == blog_post_id).scalar() is None:
+        abort(404)
+
+    response = jsonify(hits=format_hits(count_hit(blog_post_id)), csrf_token=generate_csrf())
+    response.cache_control.no_store = True
+    return response
 
 
 @bp.route("/authors/<int:author_id>/")
 @bp.route("/authors/<int:author_id>/<string:_name>/")
+@conditional_on_content
 @cache.cached()
 def route_author(author_id: int, _name: str = "") -> any:
-    if (author := db.query(Author).get(author_id)) is None:
+    if (author := get_author_with_blog_posts(author_id)) is None:
         abort(404)
 
+    tag_page(author_tag(author.id), *get_listing_tags(author.blog_posts))
+
     return render_template("author.html", title=f"Author: \"{author.name}\"", return_to_root=True,
                            author=author)
 
 
 @bp.route("/tags/<int:tag_id>/")
 @bp.route("/tags/<int:tag_id>/<string:_name>/")
+@conditional_on_content
 @cache.cached()
 def route_tag(tag_id: int, _name: str = "") -> any:
     # The "name" parameter is called "_name" to avoid unused variable
     # warnings in PyCharm. It is not beautiful but better than someone
     # removing them just by following suggestions.
-    if (tag := db.query(Tag).get(tag_id)) is None:
+    if (tag := get_tag_with_blog_posts(tag_id)) is None:
         abort(404)
 
+    tag_page(tag_tag(tag.id), *get_listing_tags(tag.blog_posts))
+
     title = f"Posts in category \"{tag.name}\":" if tag.main_section else f"Posts with tag \"{tag.name}\":"
     return render_template("tag.html", title=title, return_to_root=True,
                            tag=tag)
 
 
 @bp.route("/files")
+@bp.route("/files/<any(older, newer):direction>/<string:cursor>/")
+@conditional_on_content
 @cache.cached()
-def route_files() -> any:
-    blog_posts = get_all_visible_blog_posts().order_by(BlogPost.timestamp.desc()).all()
-    file_count = sum(len(blog_post.file_resources) for blog_post in blog_posts)
+def route_files(direction: str = "older", cursor: str = None) -> any:
+    listing_page = get_listing_page(get_newest_visible_blog_posts_with_files(), FILE_POSTS_PER_PAGE, direction, cursor)
+    tag_page("files", *get_listing_tags(listing_page["blog_posts"]))
     return render_template("files.html", title="File Index", return_to_root=True,
-                           blog_posts=blog_posts, file_count=file_count)
+                           file_count=count_visible_file_resources(), **listing_page)
+
+
+def highlight_snippet(snippet: str) -> Markup:
+    # Escape the post text first, then turn the match markers into html.
+    return Markup(str(escape(snippet)).replace(SEARCH_MATCH_START, "<mark>").replace(SEARCH_MATCH_END, "</mark>"))
+
+
+def get_search_arguments() -> Tuple[str, int]:
+    return " ".join(request.args.get("q", "").split()), max(request.args.get("page", 1, type=int), 1)
+
+
+def get_search_cache_key() -> str:
+    # Only what the page shows, so that made up parameters can't fill the cache.
+    query, page = get_search_arguments()
+    return f"search/{page}/{query}"
+
+
+@bp.route("/search")
+@conditional_on_content
+@cache.cached(key_prefix=get_search_cache_key)
+def route_search() -> any:
+    query, page = get_search_arguments()
+
+    # Fetch one more result than shown to know if there is a next page.
+    results = search_visible_blog_posts(query, SEARCH_RESULTS_PER_PAGE + 1, (page - 1) * SEARCH_RESULTS_PER_PAGE)
+    tag_page("search", *get_listing_tags(blog_post for blog_post, _ in results))
+    return render_template("search.html", title="Search", return_to_root=True, query=query, page=page,
+                           results=[(blog_post, highlight_snippet(snippet)) for blog_post, snippet
+                                    in results[:SEARCH_RESULTS_PER_PAGE]],
+                           has_next_page=len(results) > SEARCH_RESULTS_PER_PAGE)
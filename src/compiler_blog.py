@@ -1,24 +1,45 @@
-from compiler_core import compile_post
+from compiler_core import compile_posts, SymbolTable
+from compiler_manifest import build_manifest
 from misc import done, lenient_error, nothing_to_do
 from readable_queries import get_all_blog_posts
 from sqlbase import BlogPost
 
 
-def compile_blog_post(blog_post: BlogPost) -> None:
-    print(f"Compiling blog post \"{blog_post.name}\"... ", end="", flush=True)
+def compile_blog_posts(blog_posts: list, symbol_table: SymbolTable) -> None:
+    # The posts are compiled in parallel, but reported in order.
+    for blog_post, resolved_references in compile_posts(blog_posts, symbol_table):
+        print(f"Compiling blog post \"{blog_post.name}\"... ", end="", flush=True)
+        if resolved_references is not None:
+            build_manifest.record(blog_post, resolved_references)
+            done()
+        else:
+            print("Missing references!")
+
+
+def compile_blog_post(blog_post: BlogPost, symbol_table: SymbolTable) -> None:
     if blog_post.include_in_graph:
+        print(f"Compiling blog post \"{blog_post.name}\"... ", end="", flush=True)
         lenient_error("Cannot compile graph page individually!")
         return
 
-    compile_post(blog_post)
-    done()
+    compile_blog_posts([blog_post], symbol_table)
 
 
-def compile_all_blog_posts() -> None:
+def compile_all_blog_posts(incremental: bool = True, symbol_table: SymbolTable = None) -> None:
+    """Unless a symbol table is passed in to be reused, missing references are reported at the end."""
     print("Compiling blog posts...")
     if blog_posts := get_all_blog_posts().all():
-        for blog_post in blog_posts:
-            compile_blog_post(blog_post)
+        owns_symbol_table = symbol_table is None
+        symbol_table = symbol_table or SymbolTable()
+        dirty_blog_posts = [blog_post for blog_post in blog_posts
+                            if not incremental or build_manifest.is_dirty(blog_post, symbol_table)]
+        compile_blog_posts(dirty_blog_posts, symbol_table)
+
+        build_manifest.save()
+        if skipped_count := len(blog_posts) - len(dirty_blog_posts):
+            print(f"Skipped {skipped_count} unchanged blog posts.")
+        if owns_symbol_table:
+            symbol_table.report_missing_references()
         done()
 
     else:
@@ -1,31 +1,299 @@
+import functools
+import html
 import imghdr
 import os
 import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from shutil import copyfile, rmtree
-from typing import Optional
+from typing import Optional, Callable, Iterator, NamedTuple, Tuple
 
 import markdown
-from PIL import Image
+from PIL import Image, ImageOps
 
-from sqlbase import BlogPost, Tag, Author, db, FileResource
-from misc import critical_error, has_prefix, in_res_path, read_file, write_file, file_name_to_title, hash_file, done, \
-    GENERATED_RESOURCES_PATH
+try:
+    from markdown_it import MarkdownIt
+except ImportError:
+    MarkdownIt = None  # Optional, only needed for the "commonmark" Markdown renderer.
+
+try:
+    import pillow_avif
+except ImportError:
+    pillow_avif = None  # Optional, teaches Pillow versions without AVIF support to write it.
+
+from exceptions import MissingReferenceException
+from sqlbase import BlogPost, Tag, Author, db, FileResource, Nameable, update_search_index, slugify
+from shared_cache import invalidate_cached_pages, post_tag
+from misc import critical_error, lenient_error, has_prefix, in_res_path, read_file, write_file, file_name_to_title, \
+    hash_file, done, nothing_to_do, read_config, bump_content_generation, GENERATED_RESOURCES_PATH
 
 RESOURCE_PATH_INSERT = re.compile(r"{{(.*?)}}")
+HTML_TAG = re.compile(r"<[^>]+>")
 MAX_THUMBNAIL_WIDTH = 512
-IMAGE_FORMAT = "png"
 
+# Markdown images of files, like ![alt text]({{ file: photo.jpg }} "title").
+MARKDOWN_IMAGE_REFERENCE = re.compile(r"!\[([^\]]*)\]\(\s*{{\s*file:(.*?)}}\s*(?:\"([^\"]*)\")?\s*\)")
+
+# Pillow format: (file extension, mime type, save options), best format first.
+IMAGE_FORMATS = {
+    "AVIF": ("avif", "image/avif", {"quality": 60}),
+    "WEBP": ("webp", "image/webp", {"quality": 80, "method": 6}),
+    "JPEG": ("jpg", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+    "PNG": ("png", "image/png", {"optimize": True}),
+}
+
+# Images are stored in each of these widths which is smaller than the image, and in its full width.
+# That's done in each of the configured formats Pillow can write, and in JPEG (PNG if the image is transparent)
+# for browsers which support none of them.
+DEFAULT_IMAGE_WIDTHS = [240, 480, 960, 1440]
+DEFAULT_IMAGE_FORMATS = ["avif", "webp"]
+
+# How wide images are shown, see the max-width of img in base.css.
+DEFAULT_IMAGE_SIZES = "(max-width: 30rem) 100vw, 30rem"
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Posts are handed to the compiler workers in batches of this many.
+WORKER_CHUNK_SIZE = 4
+
+MARKDOWN_EXTENSIONS = ["sane_lists", "md_in_html", "extra"]
+DEFAULT_MARKDOWN_RENDERER = "python-markdown"
+
+
+class SymbolTable:
+    """
+    Everything a reference can point to, loaded in a few queries at the start of a compile, so that
+    references are resolved without going to the database. Missing references are collected instead of
+    stopping the compile, so that all of them can be reported at once.
+    """
+
+    def __init__(self) -> None:
+        # Plain (id, slug) tuples, as the objects themselves are expired by every commit while compiling.
+        self.__objects = {
+            BlogPost: {blog_post_id: (blog_post_id, slugify(name))
+                       for blog_post_id, name in db.query(BlogPost.id, BlogPost.name)},
+            Author: self.__by_name(db.query(Author.id, Author.name)),
+            Tag: self.__by_name(db.query(Tag.id, Tag.name)),
+        }
+
+        # Maps the post id to the {clear name: hashed name} dict of its files, and to the
+        # {clear name: [(hashed name, width, height, is thumbnail)]} dict of the stored variants of its images.
+        self.__file_resources = defaultdict(dict)
+        self.__images = defaultdict(dict)
+        for file_resource in db.query(FileResource.blog_post_id, FileResource.clear_name, FileResource.name,
+                                      FileResource.source_name, FileResource.width, FileResource.height,
+                                      FileResource.is_thumbnail):
+            self.__add_file_resource(*file_resource)
+
+        # (post name, message) tuples.
+        self.missing_references = list()
+
+    @staticmethod
+    def __by_name(rows: any) -> dict:
+        objects = dict()
+        for object_id, name in rows:
+            objects.setdefault(name, (object_id, slugify(name)))
+        return objects
+
+    def find(self, object_class: type, key: any) -> Optional[tuple]:
+        """The (id, slug) of a post by id, or of an author or tag by name."""
+        return self.__objects[object_class].get(key)
+
+    def __add_file_resource(self, blog_post_id: int, clear_name: str, name: str, source_name: Optional[str],
+                            width: Optional[int], height: Optional[int], is_thumbnail: bool) -> None:
+        self.__file_resources[blog_post_id][clear_name] = name
+        if source_name:
+            self.__images[blog_post_id].setdefault(source_name, []).append((name, width, height, is_thumbnail))
+
+    def find_file_resource(self, blog_post_id: int, clear_name: str) -> Optional[str]:
+        return self.__file_resources[blog_post_id].get(clear_name)
+
+    def find_image_variants(self, blog_post_id: int, clear_name: str) -> Optional[list]:
+        return self.__images[blog_post_id].get(clear_name)
+
+    def update_file_resources(self, blog_post: BlogPost) -> None:
+        # Compiling a post recreates its file resources.
+        self.__file_resources[blog_post.id] = dict()
+        self.__images[blog_post.id] = dict()
+        for fr in blog_post.file_resources:
+            self.__add_file_resource(blog_post.id, fr.clear_name, fr.name, fr.source_name, fr.width, fr.height,
+                                     fr.is_thumbnail)
+
+    def report_missing_references(self, lenient: bool = False) -> None:
+        """Stops the program unless lenient, then the references are forgotten once reported."""
+        if not self.missing_references:
+            return
+
+        for post_name, message in self.missing_references:
+            print(f"In \"{post_name}\": {message}")
+
+        message = f"{len(self.missing_references)} missing references, the affected posts were not compiled!"
+        if not lenient:
+            critical_error(message)
+
+        lenient_error(message)
+        self.missing_references.clear()
+
+
+class PythonMarkdownRenderer:
+    """Python-Markdown with the extensions the posts are written for."""
+
+    def __init__(self) -> None:
+        self.__markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        self.__inline_pattern_count = len(self.__markdown.inlinePatterns)
+
+    def render(self, markdown_src: str) -> str:
+        # Loading the extensions takes longer than converting most posts, so the instance is reused.
+        # Resetting it drops what the last post left behind, e.g. its footnotes.
+        html_src = self.__markdown.reset().convert(markdown_src)
+
+        # Abbreviations become inline patterns, which survive resetting, so posts defining some get a new instance.
+        if len(self.__markdown.inlinePatterns) != self.__inline_pattern_count:
+            self.__markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        return html_src
+
+
+class CommonMarkRenderer:
+    """markdown-it-py, a lot faster, but it speaks CommonMark (with tables) instead of the Python-Markdown dialect."""
+
+    def __init__(self) -> None:
+        if MarkdownIt is None:
+            critical_error("The \"commonmark\" Markdown renderer needs the markdown-it-py package!")
+
+        self.__markdown_it = MarkdownIt("commonmark").enable("table")
+
+    def render(self, markdown_src: str) -> str:
+        return self.__markdown_it.render(markdown_src)
+
+
+MARKDOWN_RENDERERS = {
+    "python-markdown": PythonMarkdownRenderer,
+    "commonmark": CommonMarkRenderer,
+}
+
+
+def get_markdown_renderer_name() -> str:
+    return read_config().get("MARKDOWN_RENDERER", DEFAULT_MARKDOWN_RENDERER)
+
+
+def get_output_settings() -> dict:
+    """The settings which change the compiled html or the image variants of a post."""
+    config = read_config()
+    return {
+        "markdown_renderer": get_markdown_renderer_name(),
+        "image_widths": config.get("IMAGE_WIDTHS", DEFAULT_IMAGE_WIDTHS),
+        "image_formats": config.get("IMAGE_FORMATS", DEFAULT_IMAGE_FORMATS),
+        "image_sizes": config.get("IMAGE_SIZES", DEFAULT_IMAGE_SIZES),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_markdown_renderer() -> any:
+    """The renderer selected with MARKDOWN_RENDERER in the config, one per process."""
+    if (renderer_class := MARKDOWN_RENDERERS.get(name := get_markdown_renderer_name())) is None:
+        critical_error(f"Unknown Markdown renderer \"{name}\", use one of: {', '.join(MARKDOWN_RENDERERS)}!")
+
+    return renderer_class()
+
+
+class PostJob(NamedTuple):
+    """What a worker process needs to know about a post, the ORM objects stay with the coordinator."""
+    id: int
+    name: str
+    markdown_path: str
+    interstage_path: str
+    html_path: str
+
+    @classmethod
+    def of(cls, post: BlogPost) -> "PostJob":
+        return cls(post.id, post.name, post.markdown_path, post.interstage_path, post.html_path)
+
+
+# The object shared with all functions run by map_in_workers, set once per worker process.
+_worker_shared = None
+
+
+def init_worker(shared: any) -> None:
+    global _worker_shared
+    _worker_shared = shared
+
+
+def call_in_worker(function: Callable, item: any) -> any:
+    return function(item, _worker_shared)
+
+
+def map_in_workers(function: Callable, items: list, shared: any) -> Iterator:
+    """
+    Call function(item, shared) for every item, spread over several processes, and yield the results in order.
+    The shared object is handed to every worker once when it starts, so it must not be changed by them.
+    The functions must not touch the database, all database writes are left to the coordinator.
+    """
+    # A single item is not worth starting a process pool for.
+    if len(items) < 2:
+        yield from (function(item, shared) for item in items)
+        return
+
+    with ProcessPoolExecutor(max_workers=read_config().get("COMPILER_WORKER_COUNT"),
+                             initializer=init_worker, initargs=(shared,)) as executor:
+        yield from executor.map(functools.partial(call_in_worker, function), items, chunksize=WORKER_CHUNK_SIZE)
+
+
+def compile_posts(posts: list, symbol_table: SymbolTable) -> Iterator[Tuple[BlogPost, Optional[dict]]]:
+    """
+    Compile posts, yielding every post along with the references to other objects it resolved, in order.
+    If some of them are missing, the post is left as it was and None is yielded instead.
+    """
+    # Recreating the file resources writes to the database, so it happens here. The images of all posts
+    # share one process pool, and the markdown is only rendered once all of the posts files are known.
+    transcode_jobs = list()
+    for post in posts:
+        transcode_jobs += recreate_file_resources_for_post(post)
+
+    # The rows only become visible once their outputs exist.
+    run_transcode_jobs(transcode_jobs)
+    db.commit()
+    for post in posts:
+        symbol_table.update_file_resources(post)
+
+    compiled_post_ids = list()
+    for post, (resolved_references, plain_text, missing_references) in \
+            zip(posts, map_in_workers(render_post, [PostJob.of(post) for post in posts], symbol_table)):
+        if missing_references:
+            symbol_table.missing_references += missing_references
+            yield post, None
+            continue
+
+        update_search_index(post, plain_text)
+        compiled_post_ids.append(post.id)
+        yield post, resolved_references
+
+    if compiled_post_ids:
+        db.commit()
+        invalidate_cached_pages([*[post_tag(post_id) for post_id in compiled_post_ids], "search"])
+        bump_content_generation()
+
+
+def render_post(job: PostJob, symbol_table: SymbolTable) -> Tuple[Optional[dict], str, list]:
+    """
+    Turn a posts interstage into html, may run in a worker process.
+    Returns the resolved references, the plain text for the search index and the missing references.
+    """
+    resolved_references = dict()
+    markdown_src = read_file(job.interstage_path)
 
-def compile_post(post: BlogPost) -> None:
-    recreate_file_resources_for_post(post)
-    convert_markdown_for_post(post)
+    # In a worker, the symbol table is a copy, so the missing references are handed back to the coordinator.
+    missing_count = len(symbol_table.missing_references)
+    markdown_src = pre_process_markdown(markdown_src, job, symbol_table, resolved_references)
+    if missing_references := symbol_table.missing_references[missing_count:]:
+        del symbol_table.missing_references[missing_count:]
+        return None, "", missing_references
 
+    html_src = get_markdown_renderer().render(markdown_src)
+    write_file(job.html_path, html_src)
+    return resolved_references, html_to_plain_text(html_src), []
 
-def convert_markdown_for_post(post: BlogPost) -> None:
-    markdown_src = read_file(post.interstage_path)
-    markdown_src = pre_process_markdown(markdown_src, post)
-    html_src = markdown.markdown(markdown_src, extensions=["sane_lists", "md_in_html", "extra"])
-    write_file(post.html_path, html_src)
+
+def html_to_plain_text(html_src: str) -> str:
+    return " ".join(html.unescape(HTML_TAG.sub(" ", html_src)).split())
 
 
 class MarkupReference:
@@ -38,66 +306,214 @@ class MarkupReference:
     def __produce_value_string(self, value: any) -> str:
         return f"\"{value}\"" if self.__resolve_by_name else value
 
-    def produce_reference(self, value: any) -> str:
-        """Create a reference of this type to be inserted into text."""
-        if self.__resolve_by_name and type(value) is int:
-            value = db.query(self.__object_class).get(value).name
+    def produce_reference(self, target: Nameable) -> str:
+        """Create a reference of this type to an object, to be inserted into text."""
+        value = target.name if self.__resolve_by_name else target.id
         return f"{{{{ {self.__keyword}: {self.__produce_value_string(value)} }}}}"
 
-    def maybe_match(self, reference: str) -> Optional[str]:
-        """Maybe match and process a reference of this type."""
+    def maybe_match(self, reference: str, symbol_table: SymbolTable, strict: bool = True) -> Optional[str]:
+        """
+        Maybe match and process a reference of this type.
+        Missing objects raise a MissingReferenceException, unless not strict, then they resolve to None.
+        """
         if decoded_reference := has_prefix(reference, self.__keyword + ":"):
             if self.__resolve_by_name:
                 decoded_reference = decoded_reference.strip("\"' ")
-                found_object = db.query(self.__object_class).filter_by(name=decoded_reference).first()
+                found_object = symbol_table.find(self.__object_class, decoded_reference)
             else:
-                found_object = db.query(self.__object_class).get(int(decoded_reference))
+                try:
+                    found_object = symbol_table.find(self.__object_class, int(decoded_reference))
+                except ValueError:
+                    found_object = None
+
             if found_object:
-                return f"/{self.__url_part}s/{found_object.id}/{found_object.slug}/"
+                object_id, slug = found_object
+                return f"/{self.__url_part}s/{object_id}/{slug}/"
 
-            user_provided_value = self.__produce_value_string(decoded_reference)
-            critical_error(f"Missing {self.__keyword} {user_provided_value}!")
+            if strict:
+                user_provided_value = self.__produce_value_string(decoded_reference)
+                raise MissingReferenceException(f"Missing {self.__keyword} {user_provided_value}!")
 
 
 BLOGPOST_MARKUP_REFERENCE = MarkupReference(BlogPost, False)
 POST_MARKUP_REFERENCE = MarkupReference(BlogPost, False, "post")
 AUTHOR_MARKUP_REFERENCE = MarkupReference(Author, True)
 TAG_MARKUP_REFERENCE = MarkupReference(Tag, True)
+SIMPLE_MARKUP_REFERENCES = [BLOGPOST_MARKUP_REFERENCE, POST_MARKUP_REFERENCE,
+                            AUTHOR_MARKUP_REFERENCE, TAG_MARKUP_REFERENCE]
+
 
+def resolve_simple_reference(reference: str, symbol_table: SymbolTable, strict: bool = True) -> Optional[str]:
+    """Resolve a post, author or tag reference to its url."""
+    for possible_reference in SIMPLE_MARKUP_REFERENCES:
+        if result := possible_reference.maybe_match(reference, symbol_table, strict):
+            return result
 
-def pre_process_markdown(markdown_src: str, blog_post: BlogPost) -> str:
+
+def pre_process_markdown(markdown_src: str, blog_post: PostJob, symbol_table: SymbolTable,
+                         resolved_references: dict = None) -> str:
     def processor(match: any) -> str:
         # The reference syntax inside of the {{ brackets }}.
         reference = match.group(1).strip()
 
-        # A file reference
-        if decoded_reference := has_prefix(reference, "file:"):
-            name_mapping = {fr.clear_name: fr.name for fr in blog_post.file_resources}
-            if hashed_file_name := name_mapping.get(decoded_reference):
-                return "/" + in_res_path(hashed_file_name)
+        try:
+            # A file reference
+            if decoded_reference := has_prefix(reference, "file:"):
+                if hashed_file_name := symbol_table.find_file_resource(blog_post.id, decoded_reference):
+                    return "/" + in_res_path(hashed_file_name)
 
-            # If the filename isn't in the mapping, the file doesn't exist.
-            critical_error(f"Missing resource \"{decoded_reference}\"!")
+                # If the filename isn't in the mapping, the file doesn't exist.
+                raise MissingReferenceException(f"Missing resource \"{decoded_reference}\"!")
 
-        # Simple references
-        for possible_reference in [BLOGPOST_MARKUP_REFERENCE, POST_MARKUP_REFERENCE,
-                                   AUTHOR_MARKUP_REFERENCE, TAG_MARKUP_REFERENCE]:
-            if result := possible_reference.maybe_match(reference):
+            # Simple references, remembered so that the build manifest can notice when their targets change.
+            if result := resolve_simple_reference(reference, symbol_table):
+                if resolved_references is not None:
+                    resolved_references[reference] = result
                 return result
 
-        critical_error(f"Invalid reference type: \"{reference}\".")
+            raise MissingReferenceException(f"Invalid reference type: \"{reference}\".")
+
+        except MissingReferenceException as exception:
+            # Keep going, to find the other missing references of this post, too.
+            symbol_table.missing_references.append((blog_post.name, str(exception)))
+            return match.group(0)
+
+    def image_processor(match: any) -> str:
+        # Stored images are shown in the best size and format the browser can use, anything else is left
+        # to the other processor, which also notices if the file doesn't exist.
+        if images := symbol_table.find_image_variants(blog_post.id, match.group(2).strip()):
+            return produce_picture_markup(images, match.group(1), match.group(3))
+        return match.group(0)
 
+    markdown_src = MARKDOWN_IMAGE_REFERENCE.sub(image_processor, markdown_src)
     return RESOURCE_PATH_INSERT.sub(processor, markdown_src)
 
 
-def recreate_file_resources_for_post(blog_post: BlogPost):
+def produce_picture_markup(images: list, alt_text: str, title: Optional[str]) -> str:
+    """A <picture> which lets the browser choose an image variant, and only loads it once it's about to be seen."""
+    mime_types = {extension: mime_type for extension, mime_type, _ in IMAGE_FORMATS.values()}
+    sizes = html.escape(read_config().get("IMAGE_SIZES", DEFAULT_IMAGE_SIZES))
+
+    thumbnail_name, thumbnail_width, thumbnail_height = None, None, None
+    srcsets = dict()
+    for name, width, height, is_thumbnail in sorted(images, key=lambda image: image[1]):
+        if is_thumbnail:
+            thumbnail_name, thumbnail_width, thumbnail_height = name, width, height
+        else:
+            srcsets.setdefault(mime_types[name.rsplit(".", 1)[-1]], []).append(f"/{in_res_path(name)} {width}w")
+
+    # The variants in the format of the thumbnail are for browsers which support none of the others.
+    fallback_srcset = ", ".join(srcsets.pop(mime_types[thumbnail_name.rsplit(".", 1)[-1]], []))
+    sources = "".join(f"<source type=\"{mime_type}\" srcset=\"{', '.join(srcset)}\" sizes=\"{sizes}\">"
+                      for mime_type, srcset in srcsets.items())
+    title_attribute = f" title=\"{html.escape(title)}\"" if title else ""
+    return (f"<picture>{sources}<img src=\"/{in_res_path(thumbnail_name)}\" srcset=\"{fallback_srcset}\" "
+            f"sizes=\"{sizes}\" width=\"{thumbnail_width}\" height=\"{thumbnail_height}\" "
+            f"alt=\"{html.escape(alt_text)}\"{title_attribute} loading=\"lazy\" decoding=\"async\"></picture>")
+
+
+def recreate_file_resources_for_post(blog_post: BlogPost) -> list:
+    """Replace the file resources of a post, returns the transcode jobs still to run before committing."""
     for file_resource in blog_post.file_resources:
         db.delete(file_resource)
-    db.commit()
-    process_resource_files(blog_post)
 
+    # The new rows reuse the unique names of the old ones, so those have to be gone first.
+    db.flush()
+    return plan_resource_files(blog_post)
+
+
+def write_output_atomically(file_name: str, writer: Callable) -> None:
+    # Existing outputs are reused without checking their contents,
+    # so a half-written file must never appear under its final name.
+    temporary_path = in_res_path(file_name + ".part")
+    writer(temporary_path)
+    os.replace(temporary_path, in_res_path(file_name))
+
+
+def is_output_present(file_name: str, expected_size: int = None) -> bool:
+    """Outputs are named after the hash of their source, so an existing one is already up to date."""
+    path = in_res_path(file_name)
+    if not os.path.isfile(path):
+        return False
+
+    size = os.path.getsize(path)
+    return size == expected_size if expected_size is not None else size > 0
+
+
+class ImageVariant(NamedTuple):
+    file_name: str
+    width: int
+    height: int
+    image_format: str
 
-def process_resource_files(blog_post: BlogPost) -> None:
+
+def get_image_formats() -> list:
+    """The configured image formats this Pillow can write, best first."""
+    Image.init()
+    image_formats = [image_format.upper() for image_format in read_config().get("IMAGE_FORMATS", DEFAULT_IMAGE_FORMATS)]
+    if unknown_formats := [image_format for image_format in image_formats if image_format not in IMAGE_FORMATS]:
+        critical_error(f"Unknown image formats: {', '.join(unknown_formats)}!")
+
+    return [image_format for image_format in image_formats if image_format in Image.SAVE]
+
+
+def has_transparency(image: Image.Image) -> bool:
+    return image.mode in ["RGBA", "LA", "PA"] or "transparency" in image.info
+
+
+def plan_image_variants(file_path: str, file_hash: str) -> Tuple[ImageVariant, list]:
+    """The thumbnail and the other variants of an image, the full size fallback last. Only reads the header."""
+    with Image.open(file_path) as image:
+        width, height = image.size
+        fallback_format = "PNG" if has_transparency(image) else "JPEG"
+
+        # Photos are often stored sideways, along with a tag telling how to turn them.
+        if image.getexif().get(EXIF_ORIENTATION_TAG) in [5, 6, 7, 8]:
+            width, height = height, width
+
+    def variant(suffix: str, variant_width: int, image_format: str) -> ImageVariant:
+        return ImageVariant(f"{file_hash}-{suffix}.{IMAGE_FORMATS[image_format][0]}", variant_width,
+                            max(1, round(height * variant_width / width)), image_format)
+
+    widths = sorted({w for w in read_config().get("IMAGE_WIDTHS", DEFAULT_IMAGE_WIDTHS) if w < width} | {width})
+    image_formats = list(dict.fromkeys([*get_image_formats(), fallback_format]))
+    variants = [variant(f"{w}w", w, image_format) for image_format in image_formats for w in widths]
+    return variant("thumb", min(MAX_THUMBNAIL_WIDTH, width), fallback_format), variants
+
+
+def transcode_image(file_path: str, variants: list) -> None:
+    # Runs in a worker process, so no database access in here.
+    with Image.open(file_path) as image:
+        mode = "RGBA" if has_transparency(image) else "RGB"
+        image = ImageOps.exif_transpose(image).convert(mode)
+
+    # Every size is only scaled down once, no matter in how many formats it is stored.
+    resized_images = dict()
+    for file_name, width, height, image_format in variants:
+        if (size := (width, height)) not in resized_images:
+            resized_images[size] = image if size == image.size else image.resize(size, Image.LANCZOS)
+
+        options = IMAGE_FORMATS[image_format][2]
+        write_output_atomically(file_name, lambda path: resized_images[size].save(path, image_format, **options))
+
+
+def run_transcode_jobs(jobs: list) -> None:
+    # Encoding images is CPU-bound, so spread the images of all compiled posts over several processes.
+    # A single image is not worth starting a process pool for.
+    if len(jobs) < 2:
+        for job in jobs:
+            transcode_image(*job)
+        return
+
+    with ProcessPoolExecutor(max_workers=read_config().get("COMPILER_WORKER_COUNT")) as executor:
+        for future in [executor.submit(transcode_image, *job) for job in jobs]:
+            future.result()  # Re-raise errors of the workers.
+
+
+def plan_resource_files(blog_post: BlogPost) -> list:
+    """Add the file resources of a post and copy the plain files, returns the images still to transcode."""
+    os.makedirs(GENERATED_RESOURCES_PATH, exist_ok=True)
+    transcode_jobs = list()
     for root, _, files in os.walk(blog_post.resources_path, topdown=True):
         for file in files:
             file_path = os.path.join(root, file)
@@ -107,31 +523,54 @@ def process_resource_files(blog_post: BlogPost) -> None:
             file_hash = hash_file(file_path)
             file_title = file_name_to_title(file)
 
-            # Optimize images for web (create thumbnails)
+            # Optimize images for web (create thumbnails and variants for srcset)
             if imghdr.what(file_path):
-                full_size_file_name = f"{file_hash}.{IMAGE_FORMAT}"
-                thumbnail_file_name = f"{file_hash}-thumb.{IMAGE_FORMAT}"
+                thumbnail, variants = plan_image_variants(file_path, file_hash)
+                full_size = variants[-1]
 
-                db.add(FileResource(full_size_file_name, "high-res-" + file, file_title, blog_post,
-                                    is_image=True, is_thumbnail=False))
+                db.add(FileResource(full_size.file_name, "high-res-" + file, file_title, blog_post,
+                                    is_image=True, is_thumbnail=False, source_name=file,
+                                    width=full_size.width, height=full_size.height))
 
-                db.add(FileResource(thumbnail_file_name, file, file_title + " (Thumbnail)", blog_post,
-                                    is_image=True, is_thumbnail=True))
+                db.add(FileResource(thumbnail.file_name, file, file_title + " (Thumbnail)", blog_post,
+                                    is_image=True, is_thumbnail=True, source_name=file,
+                                    width=thumbnail.width, height=thumbnail.height))
 
-                with Image.open(file_path) as image:
-                    image.thumbnail((MAX_THUMBNAIL_WIDTH, -1))
-                    image.save(in_res_path(thumbnail_file_name), IMAGE_FORMAT, optimize=True)
+                for variant in variants[:-1]:
+                    db.add(FileResource(variant.file_name,
+                                        f"{variant.width}w-{IMAGE_FORMATS[variant.image_format][0]}-{file}",
+                                        f"{file_title} ({variant.width}px {variant.image_format})", blog_post,
+                                        is_image=True, is_thumbnail=False, is_variant=True, source_name=file,
+                                        width=variant.width, height=variant.height))
 
-                with Image.open(file_path) as image:
-                    image.save(in_res_path(full_size_file_name), IMAGE_FORMAT, optimize=True)
+                # Skip decoding entirely if this image was already processed.
+                if missing_variants := [variant for variant in [thumbnail, *variants]
+                                        if not is_output_present(variant.file_name)]:
+                    transcode_jobs.append((file_path, missing_variants))
 
             else:
                 # Copy the file to the resources dir, no processing
                 new_file_name = file_hash + extension
                 db.add(FileResource(new_file_name, file, file_title, blog_post))
-                copyfile(file_path, in_res_path(new_file_name))
+                if not is_output_present(new_file_name, os.path.getsize(file_path)):
+                    write_output_atomically(new_file_name, functools.partial(copyfile, file_path))
 
-    db.commit()
+    return transcode_jobs
+
+
+def remove_orphaned_resources() -> None:
+    print("Removing orphaned resources... ", end="")
+    if not os.path.exists(GENERATED_RESOURCES_PATH):
+        nothing_to_do()
+        return
+
+    referenced_file_names = {name for name, in db.query(FileResource.name)}
+    orphaned_file_names = [file_name for file_name in os.listdir(GENERATED_RESOURCES_PATH)
+                           if file_name not in referenced_file_names]
+
+    for file_name in orphaned_file_names:
+        os.remove(in_res_path(file_name))
+    print(f"Done! ({len(orphaned_file_names)} files)")
 
 
 def clean_compiler_output() -> None:
@@ -1,71 +1,132 @@
 import re
 
-from compiler_core import compile_post, BLOGPOST_MARKUP_REFERENCE, AUTHOR_MARKUP_REFERENCE, TAG_MARKUP_REFERENCE
+from compiler_core import compile_posts, map_in_workers, PostJob, SymbolTable, BLOGPOST_MARKUP_REFERENCE, \
+    AUTHOR_MARKUP_REFERENCE, TAG_MARKUP_REFERENCE
+from compiler_manifest import build_manifest
 from misc import read_file, write_file, done, nothing_to_do
 from readable_queries import get_all_nodes
-from sqlbase import BlogPost, db, Author, Tag
+from sqlbase import db, Author, Tag
 
-from sqlalchemy import desc
-from sqlalchemy.sql.expression import func
 
+class ReferenceTable:
+    """All referencable terms, folded into a single regex so each page is annotated in one scan."""
 
-def create_reference_table() -> dict:
-    # Create a dict of the form "word" -> ("regex", "reference")
-    # So for example for the blogpost "spirit" -> "\[.*?\]|(spirit)", "{{ blogpost: 13 }}"
-    # The word is kept so that we can stop a page from referencing itself.
-    word_regex_reference_triples = dict()
-    graph_pages = get_all_nodes().order_by(desc(func.length(BlogPost.name))).all()
+    def __init__(self, references: dict) -> None:
+        # Maps the lowercase term to the (name, reference) tuple.
+        # The name is kept so that we can stop a page from referencing itself.
+        self.references = {name.lower(): (name, reference) for name, reference in references.items()}
+
+        # Either a "[...]" link span, which is skipped, or one of the terms (group 1).
+        self.regex = re.compile(rf"\[.*?\]|({_build_trie_regex(self.references.keys())})", flags=re.IGNORECASE)
+
+    def __len__(self) -> int:
+        return len(self.references)
+
+    def annotate(self, markdown: str, own_name: str) -> str:
+        def processor(match: any) -> str:
+            if not (word := match.group(1)):
+                return match.group(0)
+
+            name, reference = self.references[word.lower()]
+
+            # ...stop a page from referencing itself.
+            if name == own_name:
+                return word
+
+            # Turn word into syntax [word]({{ post: X }}).
+            return f"[{word}]({reference})"
+
+        return self.regex.sub(processor, markdown) if self.references else markdown
+
+
+def _build_trie_regex(words: any) -> str:
+    # Turn the words into a prefix tree and the tree into a regex, e.g. ["spirit", "spite"] -> "spi(?:rit|te)".
+    # Greedy optional groups make the regex engine prefer the longest term starting at a position, so
+    # "world spirit" is preferred over "world", and shared prefixes are only examined once per position.
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[""] = True
+
+    def to_regex(node: dict) -> str:
+        is_terminal = node.get("", False)
+        alternatives = [re.escape(char) + to_regex(child) for char, child in node.items() if char]
+        if not alternatives:
+            return ""
+
+        group = alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+        if is_terminal:
+            return f"(?:{group})?" if len(alternatives) == 1 else group + "?"
+        return group
+
+    return to_regex(trie) or "(?!)"
+
+
+def create_reference_table() -> ReferenceTable:
+    # Collect a dict of the form "word" -> "reference"
+    # So for example for the blogpost "spirit" -> "{{ blogpost: 13 }}"
+    references = dict()
+    graph_pages = get_all_nodes().all()
     node_sets = {
         AUTHOR_MARKUP_REFERENCE: db.query(Author).all(),
         TAG_MARKUP_REFERENCE: db.query(Tag).all(),
 
-        # Apply longest term first: Prefer "world spirit" over "spirit".
-        # Also last so blogposts tage precedence over author and tag names.
+        # Last so blogposts take precedence over author and tag names.
+        # The longest term is preferred by the regex itself: "world spirit" over "spirit".
         BLOGPOST_MARKUP_REFERENCE: graph_pages,
     }
 
     for reference_type, nodes in node_sets.items():
         for node in nodes:
-            regex_source = rf"\[.*?\]|({re.escape(node.name)})"
-            regex = re.compile(regex_source, flags=re.IGNORECASE)
-            word_regex_reference_triples[node.name] = (regex, reference_type.produce_reference(node.id))
+            references[node.name] = reference_type.produce_reference(node)
 
-    triples_count = len(word_regex_reference_triples)
-    graph_pages_count = len(graph_pages)
-    print(f"Generated {triples_count} referencable terms for {graph_pages_count} pages.")
-    print(f"Complexity: {triples_count * graph_pages_count} regex applications.")
-    return word_regex_reference_triples
+    reference_table = ReferenceTable(references)
+    print(f"Generated {len(reference_table)} referencable terms for {len(graph_pages)} pages.")
+    return reference_table
 
 
-def create_node_interstage(reference_table: dict, node: BlogPost) -> None:
+def create_node_interstage(job: PostJob, reference_table: ReferenceTable) -> None:
     # The interstage is the user markdown with the
     # node references mixed in. This interstage is
     # what will then be turned into html.
+    markdown = read_file(job.markdown_path)
+    write_file(job.interstage_path, reference_table.annotate(markdown, job.name))
 
-    markdown = read_file(node.markdown_path)
-    for word, (regex, reference) in reference_table.items():
-        # ...stop a page from referencing itself.
-        if word == node.name:
-            continue
 
-        # Turn word into syntax [word]({{ post: X }}).
-        # We have to do some lambda magic to avoid silly overlapping issues.
-        markdown = regex.sub(
-            lambda match: rf"[{match.group(1)}]({reference})" if match.group(1) else match.group(0),
-            markdown)
-
-    write_file(node.interstage_path, markdown)
+def compile_graph_pages(nodes: list, symbol_table: SymbolTable) -> None:
+    """Compile pages whose interstage is up to date."""
+    for node, resolved_references in compile_posts(nodes, symbol_table):
+        print(f"Compiling graph page \"{node.name}\"... ", end="", flush=True)
+        if resolved_references is not None:
+            build_manifest.record(node, resolved_references)
+            done()
+        else:
+            print("Missing references!")
 
 
-def compile_all_graph_pages() -> None:
+def compile_all_graph_pages(incremental: bool = True, symbol_table: SymbolTable = None) -> None:
+    """Unless a symbol table is passed in to be reused, missing references are reported at the end."""
     print("Compiling graph pages...")
     if nodes := get_all_nodes().all():
         reference_table = create_reference_table()
-        for node in nodes:
-            print(f"Compiling graph page \"{node.name}\"... ", end="", flush=True)
-            create_node_interstage(reference_table, node)
-            compile_post(node)
-            done()
+        owns_symbol_table = symbol_table is None
+        symbol_table = symbol_table or SymbolTable()
+
+        # The interstage is cheap to create and is what the build manifest hashes,
+        # so a changed reference table marks the affected pages as dirty, too.
+        # Annotating is a regex pass over every page, so the workers share the finished table.
+        list(map_in_workers(create_node_interstage, [PostJob.of(node) for node in nodes], reference_table))
+
+        dirty_nodes = [node for node in nodes if not incremental or build_manifest.is_dirty(node, symbol_table)]
+        compile_graph_pages(dirty_nodes, symbol_table)
+
+        build_manifest.save()
+        if skipped_count := len(nodes) - len(dirty_nodes):
+            print(f"Skipped {skipped_count} unchanged graph pages.")
+        if owns_symbol_table:
+            symbol_table.report_missing_references()
         done()
 
     else:
@@ -0,0 +1,89 @@
+import json
+import os
+
+from compiler_core import resolve_simple_reference, get_output_settings, SymbolTable
+from misc import hash_file, in_res_path, FileHashCache
+from sqlbase import BlogPost
+
+BUILD_MANIFEST_PATH = "build_manifest.json"
+
+# Bump this whenever the compiler output or the manifest format changes, so that old manifests are discarded.
+BUILD_MANIFEST_VERSION = 5
+
+
+class BuildManifest:
+    """Remembers what every post was compiled from, so that unchanged posts can be skipped."""
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__entries = dict()
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                contents = json.load(f)
+
+            # Another Markdown renderer or other image settings produce different output,
+            # so everything has to be compiled again.
+            if contents.get("version") == BUILD_MANIFEST_VERSION and contents.get("settings") == get_output_settings():
+                self.__entries = contents["posts"]
+                FileHashCache().load(contents["file_hashes"])
+
+    @staticmethod
+    def __hash_resources(post: BlogPost) -> dict:
+        resource_hashes = dict()
+        for root, _, files in os.walk(post.resources_path, topdown=True):
+            for file in files:
+                file_path = os.path.join(root, file)
+                resource_hashes[os.path.relpath(file_path, post.resources_path)] = hash_file(file_path)
+
+        return resource_hashes
+
+    def is_dirty(self, post: BlogPost, symbol_table: SymbolTable) -> bool:
+        """Check if the post or anything it references changed since it was last compiled."""
+        if (entry := self.__entries.get(str(post.id))) is None:
+            return True
+
+        # The output might have been deleted by hand.
+        if not os.path.exists(post.html_path) or \
+                not all(os.path.exists(in_res_path(fr.name)) for fr in post.file_resources):
+            return True
+
+        if entry["source"] != hash_file(post.interstage_path) or entry["resources"] != self.__hash_resources(post):
+            return True
+
+        # A referenced post, author or tag might have been renamed or deleted, changing its url.
+        return any(resolve_simple_reference(reference, symbol_table, strict=False) != url
+                   for reference, url in entry["references"].items())
+
+    def record(self, post: BlogPost, resolved_references: dict) -> None:
+        self.__entries[str(post.id)] = {
+            "source": hash_file(post.interstage_path),
+            "resources": self.__hash_resources(post),
+            "references": resolved_references,
+        }
+
+    def get_linking_post_ids(self, post_ids: set) -> set:
+        """The ids of the posts which were compiled with a link to one of the posts."""
+        url_prefixes = tuple(f"/blogposts/{post_id}/" for post_id in post_ids)
+        return {int(post_id) for post_id, entry in self.__entries.items()
+                if any(url.startswith(url_prefixes) for url in entry["references"].values())}
+
+    def forget(self, post: BlogPost) -> None:
+        self.__entries.pop(str(post.id), None)
+
+    def prune(self, existing_post_ids: set) -> None:
+        """Drop entries of posts which no longer exist."""
+        for post_id in [post_id for post_id in self.__entries if int(post_id) not in existing_post_ids]:
+            self.__entries.pop(post_id)
+
+    def clear(self) -> None:
+        self.__entries.clear()
+
+    def save(self) -> None:
+        with open(self.__path, "w") as f:
+            json.dump({"version": BUILD_MANIFEST_VERSION, "settings": get_output_settings(),
+                       "posts": self.__entries,
+                       "file_hashes": FileHashCache().export()}, f, indent=2, sort_keys=True)
+
+
+build_manifest = BuildManifest(BUILD_MANIFEST_PATH)
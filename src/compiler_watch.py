@@ -0,0 +1,118 @@
+import os
+import time
+from typing import Tuple
+
+from sqlalchemy.orm import joinedload
+
+from compiler_blog import compile_blog_posts
+from compiler_core import PostJob, SymbolTable
+from compiler_graph import compile_graph_pages, create_node_interstage, create_reference_table
+from compiler_manifest import build_manifest
+from exporter import precompile_sitemap
+from readable_queries import get_all_posts
+from sqlbase import BlogPost
+
+BLOG_POSTS_PATH = "blogposts"
+
+# How often the post files are checked for changes (in seconds).
+WATCH_POLL_INTERVAL = 0.1
+
+# Editors tend to save in several steps, so compiling waits until nothing changed for this long (in seconds).
+WATCH_DEBOUNCE_TIME = 0.2
+
+# Written by the compiler itself, or uploaded by visitors.
+IGNORED_FILE_NAMES = {"post.html", "interstage.md"}
+IGNORED_DIRECTORY_NAMES = {"upload"}
+
+
+def take_snapshot() -> dict:
+    """Maps the path of every post source file to its (modification time, size)."""
+    snapshot = dict()
+    for root, directories, files in os.walk(BLOG_POSTS_PATH, topdown=True):
+        directories[:] = [directory for directory in directories if directory not in IGNORED_DIRECTORY_NAMES]
+        for file in files:
+            if file not in IGNORED_FILE_NAMES:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Deleted in the meantime, e.g. an editors temporary file.
+
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+    return snapshot
+
+
+def wait_for_changes(snapshot: dict) -> Tuple[dict, set]:
+    """Wait until files were changed and then left alone for a moment, returns the new snapshot and the paths."""
+    changed_paths = set()
+    last_change_time = 0
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        new_snapshot = take_snapshot()
+        if new_changed_paths := {path for path in snapshot.keys() | new_snapshot.keys()
+                                 if snapshot.get(path) != new_snapshot.get(path)}:
+            changed_paths |= new_changed_paths
+            last_change_time = time.monotonic()
+            snapshot = new_snapshot
+
+        elif changed_paths and time.monotonic() - last_change_time >= WATCH_DEBOUNCE_TIME:
+            return snapshot, changed_paths
+
+
+def find_touched_posts(changed_paths: set) -> list:
+    # Post files are stored below "blogposts/<author>/<post>/".
+    posts_by_path = {os.path.normpath(post.slug_path): post
+                     for post in get_all_posts().options(joinedload(BlogPost.author))}
+
+    touched_posts = dict()
+    for path in changed_paths:
+        post_path = os.path.join(*os.path.normpath(path).split(os.sep)[:3])
+        if post := posts_by_path.get(post_path):
+            touched_posts[post.id] = post
+
+    return list(touched_posts.values())
+
+
+def compile_touched_posts(touched_posts: list) -> bool:
+    """Compile the touched posts and the ones linking to them, if they changed. Returns if any of them did."""
+    symbol_table = SymbolTable()
+
+    # The links to a post only change along with its name, the build manifest notices that.
+    linking_post_ids = build_manifest.get_linking_post_ids({post.id for post in touched_posts})
+    posts = {post.id: post for post in [*touched_posts, *get_all_posts().filter(BlogPost.id.in_(linking_post_ids))]}
+
+    if nodes := [post for post in posts.values() if post.include_in_graph]:
+        reference_table = create_reference_table()
+        for node in nodes:
+            create_node_interstage(PostJob.of(node), reference_table)
+
+    # Saving a file without changing it, or an editors temporary file, doesn't make a post dirty.
+    dirty_posts = [post for post in posts.values() if build_manifest.is_dirty(post, symbol_table)]
+    compile_blog_posts([post for post in dirty_posts if not post.include_in_graph], symbol_table)
+    compile_graph_pages([post for post in dirty_posts if post.include_in_graph], symbol_table)
+
+    build_manifest.save()
+    symbol_table.report_missing_references(lenient=True)
+    return bool(dirty_posts)
+
+
+def watch_posts() -> None:
+    """
+    Compile posts as soon as their files are saved. Compiling invalidates the affected
+    cached pages and bumps the content generation, so a running app shows the changes right away.
+    """
+    print(f"Watching \"{BLOG_POSTS_PATH}/\" for changes, press Ctrl+C to stop...")
+    snapshot = take_snapshot()
+    try:
+        while True:
+            snapshot, changed_paths = wait_for_changes(snapshot)
+            start_time = time.perf_counter()
+            if compile_touched_posts(find_touched_posts(changed_paths)):
+                print(f"Done in {time.perf_counter() - start_time:.2f}s.")
+
+    except KeyboardInterrupt:
+        print()
+
+    # The sitemap shows when posts were compiled, it's only written once instead of after every save.
+    precompile_sitemap()
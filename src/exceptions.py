@@ -8,3 +8,7 @@ class PostNotFoundException(BlogManagerException):
 
 class CancelledException(BlogManagerException):
     pass
+
+
+class MissingReferenceException(Exception):
+    pass
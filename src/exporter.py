@@ -0,0 +1,159 @@
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+from flask import url_for
+
+from main import create_app
+from misc import read_config, done
+from precompressed import write_precompressed_tree
+from readable_queries import get_blog_post_page, format_page_cursor, get_newest_visible_blog_posts, \
+    get_newest_visible_blog_posts_with_files
+from sitemap import write_sitemap, get_base_url, SITEMAP_PATH
+from sqlbase import db, BlogPost, Author, Tag
+
+# Where the prebuilt html tree is written to. Point the web server's document root here.
+STATIC_EXPORT_PATH = "static_export"
+
+# Pages are rendered as if they were requested from this url (this matters for the sitemap and opengraph tags).
+DEFAULT_SITE_URL = "http://localhost/"
+
+# Set in every worker process by init_export_worker.
+_client = None
+
+
+def get_site_url() -> str:
+    return read_config().get("SITE_URL", DEFAULT_SITE_URL)
+
+
+def create_export_app() -> any:
+    app = create_app()
+
+    # Rendering every page once is not a real visit.
+    app.config["COUNT_HITS"] = False
+
+    # Leaves out what differs per visit, e.g. the hits and the comment form token.
+    app.config["STATIC_EXPORT"] = True
+    return app
+
+
+def collect_listing_urls(endpoint: str, query: any, count: int) -> list:
+    # Every page after the first one can be reached by going to older posts, and from there back to newer ones.
+    urls = list()
+    blog_posts, has_more = get_blog_post_page(query, None, False, count)
+    while has_more:
+        cursor = format_page_cursor(blog_posts[-1])
+        blog_posts, has_more = get_blog_post_page(query, (blog_posts[-1].timestamp, blog_posts[-1].id), False, count)
+        urls.append(url_for(endpoint, direction="older", cursor=cursor))
+        urls.append(url_for(endpoint, direction="newer", cursor=format_page_cursor(blog_posts[0])))
+
+    return urls
+
+
+def collect_export_urls(app: any) -> list:
+    with app.test_request_context():
+        urls = [
+            url_for("home.route_root"),
+            url_for("home.route_posts"),
+            url_for("home.route_files"),
+            url_for("home.route_backlinks"),
+            url_for("home.sitemap_route"),
+            *["/" + file_name for file_name in sorted(os.listdir(SITEMAP_PATH))
+              if file_name.startswith("sitemap-") and file_name.endswith(".xml")],
+            "/robots.txt",
+            "/favicon.ico",
+        ]
+
+        # Imported here like in create_app, the blueprint module needs the app set up first.
+        from blueprints.home import POSTS_PER_PAGE, FILE_POSTS_PER_PAGE
+        urls += collect_listing_urls("home.route_posts", get_newest_visible_blog_posts(), POSTS_PER_PAGE)
+        urls += collect_listing_urls("home.route_files", get_newest_visible_blog_posts_with_files(),
+                                     FILE_POSTS_PER_PAGE)
+
+        urls += [url_for("home.route_blog_post", blog_post_id=post.id, _name=post.slug) for post in db.query(BlogPost)]
+        urls += [url_for("home.route_tag", tag_id=tag.id, _name=tag.slug) for tag in db.query(Tag)]
+        urls += [url_for("home.route_author", author_id=author.id, _name=author.slug) for author in db.query(Author)]
+
+    return urls
+
+
+def url_to_export_path(url: str) -> str:
+    # "/tags/1/name/" and "/files" become directories with an index.html, "/sitemap.xml" stays a file.
+    path = url.strip("/")
+    if "." not in path.rsplit("/", 1)[-1]:
+        path = os.path.join(path, "index.html")
+
+    return os.path.join(STATIC_EXPORT_PATH, path)
+
+
+def init_export_worker() -> None:
+    global _client
+    _client = create_export_app().test_client()
+
+
+def export_page(url: str) -> Tuple[str, int]:
+    response = _client.get(url, base_url=get_site_url())
+    if response.status_code == 200:
+        path = url_to_export_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(response.get_data())
+
+    return url, response.status_code
+
+
+def export_error_page() -> None:
+    # For the web server's error_page directive.
+    response = _client.get("/this-page-does-not-exist")
+    with open(os.path.join(STATIC_EXPORT_PATH, "404.html"), "wb") as f:
+        f.write(response.get_data())
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    # Generated resources can be large, don't store them twice if we don't have to.
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def precompile_sitemap() -> None:
+    print("Writing sitemap... ", end="")
+    with create_export_app().test_request_context(base_url=get_site_url()):
+        write_sitemap(get_base_url())
+    done()
+
+
+def export_static_site() -> None:
+    print("Exporting static site...")
+    if os.path.exists(STATIC_EXPORT_PATH):
+        shutil.rmtree(STATIC_EXPORT_PATH)
+
+    precompile_sitemap()
+
+    # The root page is rendered here first, so that the asset bundles
+    # are built before the workers start rendering pages in parallel.
+    init_export_worker()
+    urls = collect_export_urls(_client.application)
+    results = [export_page(urls[0])]
+    export_error_page()
+
+    # Spawn instead of fork, so that every worker opens its own database connection.
+    with ProcessPoolExecutor(max_workers=read_config().get("COMPILER_WORKER_COUNT"),
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_export_worker) as executor:
+        results += executor.map(export_page, urls[1:], chunksize=16)
+
+    for url, status_code in results:
+        if status_code != 200:
+            print(f"Skipped \"{url}\" (status {status_code}).")
+
+    shutil.copytree("static", os.path.join(STATIC_EXPORT_PATH, "static"), copy_function=link_or_copy)
+    print(f"Exported {len(results)} pages to \"{STATIC_EXPORT_PATH}\".")
+
+    # For gzip_static and brotli_static in nginx.
+    print("Precompressing pages... ", end="")
+    write_precompressed_tree(STATIC_EXPORT_PATH)
+    done()
@@ -0,0 +1,120 @@
+import atexit
+import logging
+import threading
+
+from collections import Counter
+
+from sqlalchemy import bindparam, select, update
+
+from sqlbase import BlogPost
+
+# Pending hits are written, and the hits written by other worker processes read, at least this often (in seconds)...
+HIT_FLUSH_INTERVAL = 5
+
+# ...or as soon as this many have accumulated.
+HIT_FLUSH_THRESHOLD = 100
+
+
+class HitCounter:
+    """Collects hits in memory and writes them in batches, so readers don't queue up for the database write lock."""
+
+    def __init__(self, engine: any) -> None:
+        self.__engine = engine
+        self.__table = BlogPost.__table__
+        self.__lock = threading.Lock()
+
+        # Only one flush at a time, e.g. the one at exit and the one of the thread.
+        self.__flush_lock = threading.Lock()
+
+        self.__pending_hits = Counter()
+        self.__pending_count = 0
+
+        # Hits taken out of pending_hits but not yet visible in stored_hits.
+        self.__flushing_hits = Counter()
+
+        # Hits of each post as of the last flush.
+        self.__stored_hits = dict()
+
+        self.__flush_requested = threading.Event()
+        self.__flush_thread = None
+        atexit.register(self.flush)
+
+    def __ensure_flush_thread(self) -> None:
+        if self.__flush_thread is None:
+            self.__flush_thread = threading.Thread(target=self.__run, name="HitCounter", daemon=True)
+            self.__flush_thread.start()
+
+    def __run(self) -> None:
+        while True:
+            self.__flush_requested.wait(HIT_FLUSH_INTERVAL)
+            self.__flush_requested.clear()
+
+            try:
+                self.flush()
+            except Exception as exception:
+                # Keep the pending hits, maybe the database is just locked right now.
+                logging.error(f"HitCounter: Flushing failed: {exception}")
+
+    def count(self, post_id: int) -> None:
+        with self.__lock:
+            self.__pending_hits[post_id] += 1
+            self.__pending_count += 1
+            if self.__pending_count >= HIT_FLUSH_THRESHOLD:
+                self.__flush_requested.set()
+
+            self.__ensure_flush_thread()
+
+    def get_hits(self, post_id: int) -> int:
+        with self.__lock:
+            stored_hits = self.__stored_hits.get(post_id)
+            unstored_hits = self.__pending_hits[post_id] + self.__flushing_hits[post_id]
+
+            # Keeps the stored hits fresh, even in a worker which doesn't count any new ones.
+            self.__ensure_flush_thread()
+
+        if stored_hits is None:
+            with self.__engine.connect() as connection:
+                stored_hits = connection.execute(
+                    select([self.__table.c.hits]).where(self.__table.c.id == post_id)).scalar() or 0
+
+            with self.__lock:
+                self.__stored_hits.setdefault(post_id, stored_hits)
+
+        return stored_hits + unstored_hits
+
+    def flush(self) -> None:
+        """Write the pending hits, and read the hits of all posts, including the ones of other worker processes."""
+        with self.__flush_lock:
+            with self.__lock:
+                flushing_hits, self.__pending_hits = self.__pending_hits, Counter()
+                self.__flushing_hits = flushing_hits
+                self.__pending_count = 0
+
+                # Nothing to write and nothing shown yet, so nothing to refresh either.
+                if not flushing_hits and not self.__stored_hits:
+                    return
+
+            batch = [{"post_id": post_id, "increment": hits} for post_id, hits in flushing_hits.items()]
+            try:
+                with self.__engine.begin() as connection:
+                    if batch:
+                        connection.execute(update(self.__table)
+                                           .where(self.__table.c.id == bindparam("post_id"))
+                                           .values(hits=self.__table.c.hits + bindparam("increment")), batch)
+
+                    stored_hits = dict(connection.execute(select([self.__table.c.id, self.__table.c.hits])).fetchall())
+
+            except Exception:
+                # Only this batch goes back, so no hits are counted twice or lost.
+                with self.__lock:
+                    self.__pending_hits.update(flushing_hits)
+                    self.__pending_count += sum(flushing_hits.values())
+                    self.__flushing_hits = Counter()
+                raise
+
+            with self.__lock:
+                self.__stored_hits = stored_hits
+                self.__flushing_hits = Counter()
+
+            if batch:
+                logging.debug(f"HitCounter: Wrote hits of {len(batch)} posts.")
@@ -1,28 +1,33 @@
 import functools
 import logging
-import random
 import os
 
 from urllib.parse import urlparse
 
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, Response
 from flask_assets import Environment, Bundle
 from flask_caching import Cache
 from werkzeug.exceptions import HTTPException
 
-from misc import in_res_path
-from sqlbase import db, BlogPost
+from misc import in_res_path, GENERATED_RESOURCES_PATH
+from precompressed import send_precompressed, write_precompressed_variants
+from readable_queries import VisibleBlogPostSampler
+from sqlbase import db
 
 BLOG_NAME = "Flesh-Network"
 cache = Cache()
 
+# Generated resources are named after the hash of their source file, so they never change and can be kept for a year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
 
 def format_exception(exception: HTTPException) -> str:
     return f"Error {exception.code}: {exception.name}"
 
 
 def create_app() -> Flask:
-    app = Flask(__name__)
+    # Like the generated resources and the sitemap, the static files are found in the working directory.
+    app = Flask(__name__, static_folder=os.path.abspath("static"))
     app.config.from_json("config.json")
 
     if app.config["DEBUG_LOG_TO_FILE"]:
@@ -47,6 +52,19 @@ def create_app() -> Flask:
         in_res_path=in_res_path,
     )
 
+    # Every request gets a fresh database session.
+    @app.teardown_appcontext
+    def remove_session(_exception: any) -> None:
+        db.remove()
+
+    @app.after_request
+    def mark_immutable_resources(response: Response) -> Response:
+        if request.path.startswith("/" + GENERATED_RESOURCES_PATH) and response.status_code in [200, 304]:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
     # Caches pages to reduce server load.
     cache.init_app(app)
 
@@ -59,12 +77,26 @@ def create_app() -> Flask:
     css_base = Bundle("css/base.css", filters="cssmin", output="gen/css_base.css")
     assets.register("css_base", css_base)
 
+    # Build the bundles now instead of on the first request, so that they are compressed only once.
+    with app.app_context():
+        for bundle in [js_base, css_base]:
+            bundle.build()
+            write_precompressed_variants(os.path.join(app.static_folder, bundle.output))
+
+    def send_static_file(filename: str) -> Response:
+        return send_precompressed(app.static_folder, filename, cache_timeout=app.get_send_file_max_age(filename))
+
+    app.view_functions["static"] = send_static_file
+
     from blueprints.home import bp as home_bp
     app.register_blueprint(home_bp)
 
+    # Scanners cause lots of 404s, so this has to be cheap.
+    blog_post_sampler = VisibleBlogPostSampler()
+
     @app.errorhandler(404)
     def handle_404_error(exception: HTTPException) -> any:
-        random_blog_posts = random.sample(db.query(BlogPost).all(), 5)
+        random_blog_posts = blog_post_sampler.sample(5)
         return render_template("error_404.html", title=format_exception(exception), blog_posts=random_blog_posts,
                                exception=exception, return_to_root=True), exception.code
 
@@ -1 +1 @@
-alias manage_blog="python3 blog_manager.py && supervisorctl restart flesh-network-blog"
+alias manage_blog="python3 blog_manager.py"
@@ -1,51 +1,162 @@
+import functools
 import hashlib
+import json
 import logging
 import os
 import sys
+import threading
+import time
 
-from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+from datetime import timedelta
 from typing import Callable, NoReturn, Optional
 
 GENERATED_RESOURCES_PATH = "static/gen/res/"
+CONFIG_PATH = "config.json"
+
+# Touched whenever posts change, so that running app processes know to drop their caches.
+CONTENT_GENERATION_PATH = "content_generation"
+
+# Files are hashed in chunks of this size, so large attachments don't have to fit into memory.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# How many bytes of files the file cache may hold, least recently used files are dropped first.
+MAX_FILE_CACHE_SIZE = 64 * 1024 * 1024
 
 # How long a visitors IP address should be retained in the IP tracker.
 MAX_IP_RETENTION_TIME = timedelta(hours=24)
 
+# The IP tracker expires entries in buckets of this duration, so they are retained for up to one bucket longer.
+IP_BUCKET_DURATION = timedelta(hours=1)
+IP_BUCKET_COUNT = int(MAX_IP_RETENTION_TIME / IP_BUCKET_DURATION)
+IP_KEY_LENGTH = 8
+
 
 class FileCache:
     """Keep file contents in memory to avoid file system slowness."""
-    __cache = dict()
+
+    def __init__(self, max_size: int = MAX_FILE_CACHE_SIZE) -> None:
+        self.__max_size = max_size
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+        # Maps the path to a (modification time, size, contents) tuple, least recently used first.
+        self.__entries = OrderedDict()
+
+    def __remove(self, path: str) -> None:
+        if (entry := self.__entries.pop(path, None)) is not None:
+            self.__size -= entry[1]
 
     def get_contents(self, path: str) -> str:
-        if path in self.__cache:
-            return self.__cache[path]
+        # A stat is a lot cheaper than a read, and it notices recompiled files.
+        stat = os.stat(path)
+        with self.__lock:
+            if (entry := self.__entries.get(path)) is not None:
+                modification_time, size, contents = entry
+                if modification_time == stat.st_mtime_ns and size == stat.st_size:
+                    self.__entries.move_to_end(path)
+                    return contents
 
         logging.debug(f"FileCache: Reading file \"{path}\"...")
         with open(path, "r") as f:
-            return self.__cache.setdefault(path, f.read())
+            contents = f.read()
+
+        with self.__lock:
+            self.__remove(path)
+            if stat.st_size <= self.__max_size:
+                self.__entries[path] = (stat.st_mtime_ns, stat.st_size, contents)
+                self.__size += stat.st_size
+
+            while self.__size > self.__max_size:
+                self.__remove(next(iter(self.__entries)))
+
+        return contents
+
+
+class FileHashCache:
+    """Remember file hashes by (path, size, modification time) so unchanged files are not read again."""
+    __hashes = dict()
+
+    def get(self, path: str, length: int) -> Optional[str]:
+        stat = os.stat(path)
+        if (entry := self.__hashes.get((os.path.abspath(path), length))) is not None:
+            size, modification_time, digest = entry
+            if size == stat.st_size and modification_time == stat.st_mtime_ns:
+                return digest
+
+    def put(self, path: str, length: int, size: int, modification_time: int, digest: str) -> None:
+        self.__hashes[(os.path.abspath(path), length)] = (size, modification_time, digest)
+
+    def export(self) -> list:
+        """All entries which are still valid, e.g. to be saved alongside the build manifest."""
+        entries = list()
+        for (path, length), (size, modification_time, digest) in self.__hashes.items():
+            if os.path.exists(path) and self.get(path, length) == digest:
+                entries.append([path, length, size, modification_time, digest])
+
+        return entries
+
+    def load(self, entries: list) -> None:
+        for path, length, size, modification_time, digest in entries:
+            self.put(path, length, size, modification_time, digest)
 
 
 class IPTracker:
-    """Keeps track of recent (IP address hash, post id) tuples to make hit counting a bit less wonky"""
-    __recorded_hits = dict()
+    """Keeps track of recent (IP address, post id) hashes to make hit counting a bit less wonky"""
 
-    def remove_expired(self) -> None:
-        to_pop = list()
-        for key, timestamp in self.__recorded_hits.items():
-            if datetime.now() - timestamp > MAX_IP_RETENTION_TIME:
-                to_pop.append(key)
+    def __init__(self) -> None:
+        # Oldest bucket first, every bucket holds the keys seen during one IP_BUCKET_DURATION.
+        # Expiring drops whole buckets, so it doesn't have to look at every key.
+        self.__buckets = deque()
+
+        # Requests are handled in several threads, which must not change the buckets while another one looks.
+        self.__lock = threading.Lock()
 
-        # Alter dict afterwards to avoid a RuntimeError
-        if to_pop:
-            for pop in to_pop:
-                self.__recorded_hits.pop(pop)
+    def remove_expired(self) -> None:
+        oldest_retained_bucket = self.__current_bucket() - IP_BUCKET_COUNT + 1
+        with self.__lock:
+            while self.__buckets and self.__buckets[0][0] < oldest_retained_bucket:
+                self.__buckets.popleft()
 
     def should_count_request(self, clear_ip: str, post_id: int) -> bool:
-        key = (hash_string(clear_ip), post_id)
-        was_not_in_hits_previously = key not in self.__recorded_hits
-        self.__recorded_hits[key] = datetime.now()
+        # A fixed-width binary digest is a lot smaller than a (hex string, int) tuple.
+        key = hashlib.shake_256(f"{clear_ip}#{post_id}".encode()).digest(IP_KEY_LENGTH)
+        current_bucket = self.__current_bucket()
+
+        with self.__lock:
+            was_not_in_hits_previously = not any(key in keys for _, keys in self.__buckets)
+            if not self.__buckets or self.__buckets[-1][0] != current_bucket:
+                self.__buckets.append((current_bucket, set()))
+
+            # Seeing the key again renews it, like before.
+            self.__buckets[-1][1].add(key)
+
         return was_not_in_hits_previously
 
+    @staticmethod
+    def __current_bucket() -> int:
+        return int(time.monotonic() // IP_BUCKET_DURATION.total_seconds())
+
+
+def get_content_generation() -> int:
+    try:
+        return os.stat(CONTENT_GENERATION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def bump_content_generation() -> None:
+    """Invalidate the caches of all running app processes."""
+    with open(CONTENT_GENERATION_PATH, "a"):
+        os.utime(CONTENT_GENERATION_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def read_config() -> dict:
+    """The config shared with the Flask app, for use outside of it (e.g. in the compiler)."""
+    with open(CONFIG_PATH, "r") as f:
+        return json.load(f)
+
 
 def static_vars(**kwargs) -> Callable:
     """A decorator to make function-static variables a bit prettier"""
@@ -88,11 +199,20 @@ def write_file(path: str, content: str) -> None:
 
 
 def hash_file(path: str, length: int = 32) -> str:
+    hash_cache = FileHashCache()
+    if digest := hash_cache.get(path, length):
+        return digest
+
+    # Stat before reading, so a file changed while hashing is not cached with the new stats.
+    stat = os.stat(path)
+    hash_sum = hashlib.shake_256()
     with open(path, "rb") as f:
-        hash_sum = hashlib.shake_256()
-        hash_sum.update(f.read())
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hash_sum.update(chunk)
 
-    return hash_sum.hexdigest(length)
+    digest = hash_sum.hexdigest(length)
+    hash_cache.put(path, length, stat.st_size, stat.st_mtime_ns, digest)
+    return digest
 
 
 def hash_string(string: str, length: int = 32) -> str:
@@ -0,0 +1,93 @@
+import gzip
+import mimetypes
+import os
+
+from flask import request, send_from_directory, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Optional, without it only gzip variants are written.
+
+# Only text is worth compressing, the images are compressed already.
+COMPRESSIBLE_EXTENSIONS = {".html", ".css", ".js", ".xml", ".txt", ".svg", ".json"}
+
+
+def compress_gzip(data: bytes) -> bytes:
+    # No timestamp in the header, so the same input always gives the same file.
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compress_brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=11)
+
+
+# (content encoding, file extension, compressor), in order of preference.
+ENCODINGS = [
+    *([("br", ".br", compress_brotli)] if brotli is not None else []),
+    ("gzip", ".gz", compress_gzip),
+]
+
+
+def is_compressible(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def write_precompressed_variants(path: str) -> None:
+    """Write "file.gz" (and "file.br") next to a file, unless they are already newer than it."""
+    if not is_compressible(path):
+        return
+
+    data = None
+    source_modification_time = os.stat(path).st_mtime_ns
+    for _, extension, compress in ENCODINGS:
+        variant_path = path + extension
+        if os.path.exists(variant_path) and os.stat(variant_path).st_mtime_ns >= source_modification_time:
+            continue
+
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+
+        # Several app processes might do this at the same time, and the old variant might be served right now.
+        part_path = f"{variant_path}.{os.getpid()}.part"
+        with open(part_path, "wb") as f:
+            f.write(compress(data))
+        os.replace(part_path, variant_path)
+
+
+def remove_precompressed_variants(path: str) -> None:
+    for _, extension, _ in ENCODINGS:
+        if os.path.exists(path + extension):
+            os.remove(path + extension)
+
+
+def write_precompressed_tree(directory: str) -> int:
+    """Precompress every compressible file below a directory, e.g. for gzip_static in nginx."""
+    count = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if is_compressible(file):
+                write_precompressed_variants(os.path.join(root, file))
+                count += 1
+
+    return count
+
+
+def send_precompressed(directory: str, file_name: str, **kwargs) -> Response:
+    """Like send_from_directory, but sends a precompressed variant if there is one the client accepts."""
+    if not is_compressible(file_name):
+        return send_from_directory(directory, file_name, **kwargs)
+
+    # Nothing is compressed here, variants which don't exist yet are just skipped.
+    for encoding, extension, _ in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(directory, file_name + extension)):
+            kwargs.setdefault("mimetype", mimetypes.guess_type(file_name)[0])
+            response = send_from_directory(directory, file_name + extension, **kwargs)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_from_directory(directory, file_name, **kwargs)
+
+    response.vary.add("Accept-Encoding")
+    return response
@@ -1,4 +1,22 @@
-from sqlbase import db, BlogPost
+import random
+import re
+from array import array
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import joinedload, selectinload
+
+from misc import get_content_generation
+from sqlbase import db, BlogPost, Tag, Author, FileResource, SEARCH_TABLE_NAME
+
+# Search matches are enclosed in these in the snippets, so that the snippets can be escaped before highlighting.
+SEARCH_MATCH_START = "\x02"
+SEARCH_MATCH_END = "\x03"
+
+
+# The listing queries load everything their templates touch up front,
+# so that rendering a page takes the same number of statements no matter how many posts it shows.
 
 
 def get_all_nodes() -> any:
@@ -15,3 +33,132 @@ def get_all_posts() -> any:
 
 def get_all_visible_blog_posts() -> any:
     return db.query(BlogPost).filter_by(hidden=False)
+
+
+def get_newest_visible_blog_posts() -> any:
+    """Visible posts, newest first, along with their authors for post_link.html."""
+    return get_all_visible_blog_posts().options(joinedload(BlogPost.author)).order_by(BlogPost.timestamp.desc())
+
+
+def get_newest_visible_blog_posts_with_files() -> any:
+    return get_all_visible_blog_posts().filter(BlogPost.file_resources.any()) \
+        .options(selectinload(BlogPost.file_resources)).order_by(BlogPost.timestamp.desc())
+
+
+def count_visible_blog_posts() -> int:
+    return db.query(func.count(BlogPost.id)).filter_by(hidden=False).scalar()
+
+
+def count_visible_file_resources() -> int:
+    # The variants of images are only there for srcset, so they aren't listed.
+    return db.query(func.count(FileResource.id)).filter(FileResource.is_variant.isnot(True)) \
+        .join(FileResource.blog_post).filter_by(hidden=False).scalar()
+
+
+# Listing pages are addressed by the (timestamp, id) of the post next to them, formatted without dots and slashes.
+PAGE_CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def format_page_cursor(blog_post: BlogPost) -> str:
+    return f"{blog_post.timestamp.strftime(PAGE_CURSOR_TIME_FORMAT)}-{blog_post.id}"
+
+
+def parse_page_cursor(raw_cursor: str) -> Tuple[datetime, int]:
+    raw_timestamp, raw_blog_post_id = raw_cursor.split("-")
+    return datetime.strptime(raw_timestamp, PAGE_CURSOR_TIME_FORMAT), int(raw_blog_post_id)
+
+
+def get_blog_post_page(query: any, cursor: Optional[Tuple[datetime, int]], newer: bool,
+                       count: int) -> Tuple[list, bool]:
+    """
+    Up to count posts of a newest first query, starting after the (timestamp, id) cursor,
+    or before it if newer is set. Also tells if there are more posts in that direction.
+    """
+    # Keyset pagination: the index seeks straight to the cursor, no matter how deep into the archive it is.
+    query = query.order_by(None)
+    if cursor is not None:
+        timestamp, blog_post_id = cursor
+        if newer:
+            query = query.filter(or_(BlogPost.timestamp > timestamp,
+                                     and_(BlogPost.timestamp == timestamp, BlogPost.id > blog_post_id)))
+        else:
+            query = query.filter(or_(BlogPost.timestamp < timestamp,
+                                     and_(BlogPost.timestamp == timestamp, BlogPost.id < blog_post_id)))
+
+    if newer:
+        query = query.order_by(BlogPost.timestamp.asc(), BlogPost.id.asc())
+    else:
+        query = query.order_by(BlogPost.timestamp.desc(), BlogPost.id.desc())
+
+    # Fetch one more post than shown to know if there is another page.
+    blog_posts = query.limit(count + 1).all()
+    has_more = len(blog_posts) > count
+    blog_posts = blog_posts[:count]
+    return (blog_posts[::-1] if newer else blog_posts), has_more
+
+
+def get_non_empty_section_tags() -> any:
+    return db.query(Tag).filter_by(main_section=True).filter(Tag.blog_posts.any())
+
+
+def get_tag_with_blog_posts(tag_id: int) -> any:
+    return db.query(Tag).options(selectinload(Tag.blog_posts).joinedload(BlogPost.author)).get(tag_id)
+
+
+def get_author_with_blog_posts(author_id: int) -> any:
+    return db.query(Author).options(selectinload(Author.blog_posts)).get(author_id)
+
+
+def get_blog_post_with_relations(blog_post_id: int) -> any:
+    """A post along with everything blog_post.html shows."""
+    return db.query(BlogPost).options(joinedload(BlogPost.author), selectinload(BlogPost.tags),
+                                      selectinload(BlogPost.comments),
+                                      selectinload(BlogPost.file_resources)).get(blog_post_id)
+
+
+def build_search_query(user_query: str) -> Optional[str]:
+    # Quote every word so user input can never be FTS5 syntax, all words have
+    # to match and the last one may be incomplete: 'world spi' -> '"world" "spi"*'
+    if words := re.findall(r"\w+", user_query):
+        return " ".join(f"\"{word}\"" for word in words) + "*"
+
+
+def search_visible_blog_posts(user_query: str, limit: int, offset: int) -> list:
+    """(blog post, snippet) tuples for visible posts, best match first."""
+    if not (query := build_search_query(user_query)):
+        return []
+
+    rows = db.execute(f"SELECT {SEARCH_TABLE_NAME}.rowid, "
+                      f"snippet({SEARCH_TABLE_NAME}, 1, :match_start, :match_end, '...', 24) "
+                      f"FROM {SEARCH_TABLE_NAME} JOIN {BlogPost.__tablename__} "
+                      f"ON {BlogPost.__tablename__}.id = {SEARCH_TABLE_NAME}.rowid "
+                      f"WHERE {SEARCH_TABLE_NAME} MATCH :query AND NOT {BlogPost.__tablename__}.hidden "
+                      f"ORDER BY {SEARCH_TABLE_NAME}.rank LIMIT :limit OFFSET :offset",
+                      {"query": query, "limit": limit, "offset": offset,
+                       "match_start": SEARCH_MATCH_START, "match_end": SEARCH_MATCH_END}).fetchall()
+
+    blog_posts = get_all_posts().options(joinedload(BlogPost.author)) \
+        .filter(BlogPost.id.in_([blog_post_id for blog_post_id, _ in rows])).all()
+    blog_posts_by_id = {blog_post.id: blog_post for blog_post in blog_posts}
+    return [(blog_posts_by_id[blog_post_id], snippet) for blog_post_id, snippet in rows]
+
+
+class VisibleBlogPostSampler:
+    """Picks random visible posts without loading all of them."""
+
+    def __init__(self) -> None:
+        self.__generation = None
+        self.__blog_post_ids = array("q")
+
+    def sample(self, count: int) -> list:
+        # The ids are only reloaded when the blog manager changed something.
+        if (generation := get_content_generation()) != self.__generation:
+            self.__blog_post_ids = array("q", (blog_post_id for blog_post_id, in
+                                               get_all_visible_blog_posts().with_entities(BlogPost.id)))
+            self.__generation = generation
+
+        chosen_ids = random.sample(self.__blog_post_ids, min(count, len(self.__blog_post_ids)))
+
+        blog_posts = get_all_visible_blog_posts().options(joinedload(BlogPost.author)) \
+            .filter(BlogPost.id.in_(chosen_ids)).all()
+        return sorted(blog_posts, key=lambda blog_post: chosen_ids.index(blog_post.id))
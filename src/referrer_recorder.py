@@ -0,0 +1,82 @@
+import atexit
+import logging
+import threading
+import time
+
+from sqlalchemy import select
+
+from misc import get_content_generation
+from sqlbase import ReferrerHostname
+
+# New hostnames are written at most this often (in seconds).
+REFERRER_FLUSH_INTERVAL = 10
+
+
+class ReferrerRecorder:
+    """Remembers which hostnames are already stored and writes only new ones, in batches, in the background."""
+
+    def __init__(self, engine: any) -> None:
+        self.__engine = engine
+        self.__table = ReferrerHostname.__table__
+        self.__lock = threading.Lock()
+
+        self.__known_hostnames = set()
+        self.__new_hostnames = set()
+        self.__generation = None
+
+        self.__flush_thread = None
+        atexit.register(self.flush)
+        self.__load_known_hostnames()
+
+    def __load_known_hostnames(self) -> None:
+        # Hostnames might have been deleted using the blog manager, so reload them when something changed.
+        if (generation := get_content_generation()) != self.__generation:
+            with self.__engine.connect() as connection:
+                known_hostnames = {name for name, in connection.execute(select([self.__table.c.name]))}
+
+            with self.__lock:
+                self.__known_hostnames = known_hostnames
+                self.__generation = generation
+
+    def __ensure_flush_thread(self) -> None:
+        if self.__flush_thread is None:
+            self.__flush_thread = threading.Thread(target=self.__run, name="ReferrerRecorder", daemon=True)
+            self.__flush_thread.start()
+
+    def __run(self) -> None:
+        while True:
+            time.sleep(REFERRER_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as exception:
+                logging.error(f"ReferrerRecorder: Flushing failed: {exception}")
+
+    def record(self, hostname: str) -> None:
+        self.__load_known_hostnames()
+        with self.__lock:
+            if hostname in self.__known_hostnames:
+                return
+
+            self.__known_hostnames.add(hostname)
+            self.__new_hostnames.add(hostname)
+            self.__ensure_flush_thread()
+
+    def flush(self) -> None:
+        with self.__lock:
+            new_hostnames, self.__new_hostnames = self.__new_hostnames, set()
+
+        if not new_hostnames:
+            return
+
+        try:
+            # Another worker process might have stored the same hostname in the meantime.
+            with self.__engine.begin() as connection:
+                connection.execute(self.__table.insert().prefix_with("OR IGNORE"),
+                                   [{"name": hostname} for hostname in sorted(new_hostnames)])
+
+        except Exception:
+            with self.__lock:
+                self.__new_hostnames.update(new_hostnames)
+            raise
+
+        logging.debug(f"ReferrerRecorder: Stored {len(new_hostnames)} new hostnames.")
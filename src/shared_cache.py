@@ -0,0 +1,259 @@
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from flask import g, has_request_context
+from flask_caching.backends.base import BaseCache
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+
+from misc import read_config
+from sqlbase import db, BlogPost, Author, Tag, TagAssociation, Comment, FileResource, Friend, ReferrerHostname
+
+# One cache file per host, shared by all worker processes and the blog manager.
+DEFAULT_SHARED_CACHE_PATH = "page_cache.db"
+
+# Expired entries are deleted at most this often (in seconds).
+CACHE_PRUNE_INTERVAL = 60
+
+# At most this many entries are kept, the oldest ones are dropped first. Same default as Flask-Caching's.
+DEFAULT_CACHE_THRESHOLD = 500
+
+# Changing any of these moves a post in or out of the listings, or changes how it is shown there.
+LISTED_BLOG_POST_ATTRIBUTES = ["name", "hidden", "timestamp", "author", "author_id"]
+
+# Pages are tagged with the content they show, e.g. "post:12", "author:3", "tag:5" or "posts" for listings.
+# Changing something in the database removes exactly the pages tagged with it.
+
+
+def post_tag(blog_post_id: int) -> str:
+    return f"post:{blog_post_id}"
+
+
+def author_tag(author_id: int) -> str:
+    return f"author:{author_id}"
+
+
+def tag_tag(tag_id: int) -> str:
+    return f"tag:{tag_id}"
+
+
+def get_listing_tags(blog_posts: Iterable[BlogPost]) -> set:
+    """For pages which list posts along with their authors."""
+    return {"posts", *[author_tag(blog_post.author_id) for blog_post in blog_posts]}
+
+
+def get_changed_related(instance: any, relationship: str) -> list:
+    # Objects which were added or removed. If the relationship was never loaded, it can't have changed.
+    history = get_history(instance, relationship, passive=PASSIVE_NO_INITIALIZE)
+    return [*(history.added or []), *(history.deleted or [])]
+
+
+def get_cache_tags(instance: any, added_or_deleted: bool) -> set:
+    """The tags of the pages which show a database object."""
+    if isinstance(instance, BlogPost):
+        tags = {post_tag(instance.id), *[tag_tag(tag.id) for tag in get_changed_related(instance, "tags")]}
+
+        # The listings only show these, so they don't have to be rendered again for anything else.
+        if added_or_deleted or any(get_history(instance, attribute, passive=PASSIVE_NO_INITIALIZE).has_changes()
+                                   for attribute in LISTED_BLOG_POST_ATTRIBUTES):
+            tags.update(["posts", author_tag(instance.author_id),
+                         *[author_tag(author.id) for author in get_changed_related(instance, "author")]])
+        return tags
+
+    if isinstance(instance, Tag):
+        return {tag_tag(instance.id), "tags",
+                *[post_tag(blog_post.id) for blog_post in get_changed_related(instance, "blog_posts")]}
+
+    if isinstance(instance, TagAssociation):
+        return {post_tag(instance.blog_post_id), tag_tag(instance.tag_id), "tags"}
+
+    return {
+        Author: lambda: {author_tag(instance.id)},
+        Comment: lambda: {post_tag(instance.blog_post_id)},
+        FileResource: lambda: {post_tag(instance.blog_post_id), "files"},
+        Friend: lambda: {"friends"},
+        ReferrerHostname: lambda: {"referrers"},
+    }.get(type(instance), set)()
+
+
+def tag_page(*tags: str) -> None:
+    """Attach tags to the cache entries written during this request."""
+    if has_request_context():
+        g.setdefault("cache_tags", set()).update(tags)
+
+
+class SharedCache(BaseCache):
+    """A Flask-Caching backend in an SQLite file, so all worker processes share one cache with tagged entries."""
+
+    def __init__(self, path: str, default_timeout: int = 300, threshold: int = DEFAULT_CACHE_THRESHOLD) -> None:
+        super().__init__(default_timeout)
+        self.__path = path
+        self.__threshold = threshold
+        self.__local = threading.local()
+        self.__last_prune = 0
+
+    def __connect(self) -> sqlite3.Connection:
+        # One connection per thread, and new ones after forking.
+        if getattr(self.__local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.__path, timeout=10, isolation_level=None)
+
+            # Losing the cache in a crash doesn't matter, so don't wait for the disk.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL);
+                CREATE TABLE IF NOT EXISTS entry_tags (tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key));
+                CREATE INDEX IF NOT EXISTS entry_tags_key ON entry_tags (key);
+                CREATE TABLE IF NOT EXISTS tag_invalidations (tag TEXT PRIMARY KEY, time REAL NOT NULL);
+            """)
+
+            self.__local.connection = connection
+            self.__local.pid = os.getpid()
+
+        return self.__local.connection
+
+    def __get_expiry(self, timeout: Optional[int]) -> Optional[float]:
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else None
+
+    def __prune(self, connection: sqlite3.Connection) -> None:
+        if time.time() - self.__last_prune > CACHE_PRUNE_INTERVAL:
+            self.__last_prune = time.time()
+            connection.execute("DELETE FROM entry_tags WHERE key IN (SELECT key FROM entries WHERE expires < ?)",
+                               (time.time(),))
+            connection.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+
+    def __evict(self, connection: sqlite3.Connection) -> None:
+        # Replacing an entry gives it a new rowid, so the lowest rowids are the oldest entries.
+        excess_count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.__threshold
+        if excess_count > 0:
+            keys = connection.execute("SELECT key FROM entries ORDER BY rowid LIMIT ?", (excess_count,)).fetchall()
+            connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+            connection.executemany("DELETE FROM entry_tags WHERE key = ?", keys)
+
+    def get(self, key: str) -> any:
+        row = self.__connect().execute("SELECT value FROM entries WHERE key = ? AND "
+                                       "(expires IS NULL OR expires >= ?)", (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def has(self, key: str) -> bool:
+        return self.__connect().execute("SELECT 1 FROM entries WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+                                        (key, time.time())).fetchone() is not None
+
+    def set(self, key: str, value: any, timeout: Optional[int] = None) -> bool:
+        tags = sorted(g.get("cache_tags", set())) if has_request_context() else []
+        started = g.get("cache_request_start", time.time()) if has_request_context() else time.time()
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        connection = self.__connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+
+            # The page was rendered from data which changed in the meantime, don't store it.
+            if tags and connection.execute(f"SELECT 1 FROM tag_invalidations WHERE time >= ? AND tag IN "
+                                           f"({', '.join('?' * len(tags))})", (started, *tags)).fetchone():
+                return False
+
+            connection.execute("INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                               (key, value, self.__get_expiry(timeout)))
+            connection.execute("DELETE FROM entry_tags WHERE key = ?", (key,))
+            connection.executemany("INSERT INTO entry_tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+            self.__prune(connection)
+            self.__evict(connection)
+
+        return True
+
+    def add(self, key: str, value: any, timeout: Optional[int] = None) -> bool:
+        return not self.has(key) and self.set(key, value, timeout)
+
+    def delete(self, key: str) -> bool:
+        connection = self.__connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM entry_tags WHERE key = ?", (key,))
+            return connection.execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount > 0
+
+    def clear(self) -> bool:
+        connection = self.__connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM entry_tags")
+            connection.execute("DELETE FROM entries")
+        return True
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        """Remove every entry carrying one of the tags, returns how many were removed."""
+        if not (tags := sorted(set(tags))):
+            return 0
+
+        connection = self.__connect()
+        placeholders = ", ".join("?" * len(tags))
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            keys = [(key,) for key, in connection.execute(
+                f"SELECT DISTINCT key FROM entry_tags WHERE tag IN ({placeholders})", tags)]
+            connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+            connection.executemany("DELETE FROM entry_tags WHERE key = ?", keys)
+            connection.executemany("INSERT OR REPLACE INTO tag_invalidations (tag, time) VALUES (?, ?)",
+                                   [(tag, time.time()) for tag in tags])
+
+        return len(keys)
+
+
+def shared(app: any, config: dict, args: list, kwargs: dict) -> SharedCache:
+    """Factory for Flask-Caching, use it with "CACHE_TYPE": "shared_cache.shared"."""
+    @app.before_request
+    def remember_request_start() -> None:
+        g.cache_request_start = time.time()
+
+    kwargs.setdefault("threshold", config.get("CACHE_THRESHOLD", DEFAULT_CACHE_THRESHOLD))
+    return SharedCache(config.get("SHARED_CACHE_PATH", DEFAULT_SHARED_CACHE_PATH), *args, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_shared_cache() -> SharedCache:
+    # For use outside of the Flask app, e.g. in the blog manager and the compiler.
+    config = read_config()
+    return SharedCache(config.get("SHARED_CACHE_PATH", DEFAULT_SHARED_CACHE_PATH),
+                       threshold=config.get("CACHE_THRESHOLD", DEFAULT_CACHE_THRESHOLD))
+
+
+def invalidate_cached_pages(tags: Iterable[str]) -> None:
+    get_shared_cache().invalidate_tags(tags)
+
+
+def collect_changed_cache_tags(flushed_session: any, _flush_context: any) -> None:
+    changed_tags = flushed_session.info.setdefault("changed_cache_tags", set())
+    for instance in [*flushed_session.new, *flushed_session.deleted]:
+        changed_tags.update(get_cache_tags(instance, True))
+    for instance in flushed_session.dirty:
+        changed_tags.update(get_cache_tags(instance, False))
+
+
+def invalidate_changed_cache_tags(committed_session: any) -> None:
+    if changed_tags := committed_session.info.pop("changed_cache_tags", None):
+        invalidate_cached_pages(changed_tags)
+
+
+def forget_changed_cache_tags(rolled_back_session: any) -> None:
+    rolled_back_session.info.pop("changed_cache_tags", None)
+
+
+def invalidate_on_commit(session: any) -> None:
+    """Remove the cached pages showing objects changed in a session as soon as the changes are committed."""
+    # Only once per session, or every flush would collect the tags once per registration.
+    if event.contains(session, "after_commit", invalidate_changed_cache_tags):
+        return
+
+    event.listen(session, "after_flush", collect_changed_cache_tags)
+    event.listen(session, "after_commit", invalidate_changed_cache_tags)
+    event.listen(session, "after_rollback", forget_changed_cache_tags)
+
+
+# For the app and the blog manager alike, e.g. posting a comment removes the cached pages showing the post.
+invalidate_on_commit(db)
@@ -1,39 +1,135 @@
-import functools
-import xml.etree.cElementTree as eT
+import itertools
+import os
 
-from sqlbase import db, BlogPost, Author, Tag
-from flask import url_for, request
+from datetime import datetime, timezone
+from typing import Iterator, Tuple
+from xml.sax.saxutils import escape
+
+from sqlalchemy.orm import joinedload
 
+from precompressed import write_precompressed_variants
+from sqlbase import db, BlogPost, Author, Tag, TagAssociation
+from flask import url_for, request
 
 XML_HEADER = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
 
+# The sitemap is written at compile time and then served as files from here.
+SITEMAP_PATH = "static/gen/sitemap/"
+SITEMAP_INDEX_FILE_NAME = "sitemap.xml"
 
-def generate_sitemap() -> str:
-    # Semi-minimal sitemap implementation according to https://www.sitemaps.org/protocol.html
-    urlset = eT.Element("urlset", xmlns="http://www.sitemaps.org/schemas/sitemap/0.9")
-    insert_url = functools.partial(_insert_url, urlset, get_base_url())
-    insert_url(loc="", priority=1)
+# The protocol allows at most this many urls per sitemap file.
+MAX_URLS_PER_SITEMAP = 50000
+
+
+def get_sitemap_file_name(shard: int) -> str:
+    return f"sitemap-{shard}.xml"
+
+
+def format_lastmod(timestamp: datetime) -> str:
+    return timestamp.astimezone(timezone.utc).isoformat(timespec="seconds")
 
-    for post in db.query(BlogPost):
-        insert_url(loc=url_for("home.route_blog_post", blog_post_id=post.id, _name=post.slug),
-                   priority=0.8)
+
+def get_blog_post_lastmod(blog_post: BlogPost) -> datetime:
+    # The creation date, or when the post was compiled last.
+    if os.path.exists(blog_post.html_path):
+        return max(blog_post.timestamp, datetime.fromtimestamp(os.path.getmtime(blog_post.html_path)))
+    return blog_post.timestamp
+
+
+def generate_sitemap_entries() -> Iterator[Tuple[str, datetime, float]]:
+    """Yield (location, last modification, priority) tuples for every page. Needs a request context for url_for."""
+    # Listing pages change whenever one of the listed posts does, only the newest lastmod of each is kept.
+    tag_lastmods = dict()
+    author_lastmods = dict()
+    newest_lastmod = None
+
+    # One row per tag of a post, so the posts come in groups.
+    rows = (db.query(BlogPost, TagAssociation.tag_id)
+            .outerjoin(TagAssociation, TagAssociation.blog_post_id == BlogPost.id)
+            .options(joinedload(BlogPost.author)).order_by(BlogPost.id).yield_per(1000))
+
+    for post, post_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        lastmod = get_blog_post_lastmod(post)
+        for _, tag_id in post_rows:
+            if tag_id is not None:
+                tag_lastmods[tag_id] = max(lastmod, tag_lastmods.get(tag_id, lastmod))
+
+        author_lastmods[post.author_id] = max(lastmod, author_lastmods.get(post.author_id, lastmod))
+        newest_lastmod = max(lastmod, newest_lastmod or lastmod)
+        yield url_for("home.route_blog_post", blog_post_id=post.id, _name=post.slug), lastmod, 0.8
 
     for tag in db.query(Tag):
-        insert_url(loc=url_for("home.route_tag", tag_id=tag.id, _name=tag.slug),
-                   priority=0.6)
+        yield url_for("home.route_tag", tag_id=tag.id, _name=tag.slug), tag_lastmods.get(tag.id), 0.6
 
     for author in db.query(Author):
-        insert_url(loc=url_for("home.route_author", author_id=author.id, _name=author.slug),
-                   priority=0.4)
+        yield url_for("home.route_author", author_id=author.id, _name=author.slug), author_lastmods.get(author.id), 0.4
 
-    return XML_HEADER + eT.tostring(urlset, encoding="unicode", method="xml")
+    yield "", newest_lastmod, 1
 
 
-def get_base_url() -> str:
-    return request.base_url.rsplit("/", 1)[0]
+def generate_urlset(prefix: str, entries: Iterator[Tuple[str, datetime, float]]) -> Iterator[str]:
+    # Semi-minimal sitemap implementation according to https://www.sitemaps.org/protocol.html
+    yield XML_HEADER
+    yield f"<urlset xmlns=\"{SITEMAP_NAMESPACE}\">"
+    for loc, lastmod, priority in entries:
+        yield f"<url><loc>{escape(prefix + loc)}</loc>"
+        if lastmod:
+            yield f"<lastmod>{format_lastmod(lastmod)}</lastmod>"
+        yield f"<priority>{priority}</priority></url>"
+    yield "</urlset>"
+
+
+def generate_sitemap_index(prefix: str, shard_lastmods: list) -> Iterator[str]:
+    yield XML_HEADER
+    yield f"<sitemapindex xmlns=\"{SITEMAP_NAMESPACE}\">"
+    for shard, lastmod in enumerate(shard_lastmods, start=1):
+        yield f"<sitemap><loc>{escape(f'{prefix}/{get_sitemap_file_name(shard)}')}</loc>"
+        if lastmod:
+            yield f"<lastmod>{format_lastmod(lastmod)}</lastmod>"
+        yield "</sitemap>"
+    yield "</sitemapindex>"
+
+
+def write_xml_file(file_name: str, chunks: Iterator[str]) -> None:
+    # Write to a temporary file first, the old sitemap might be served right now.
+    path = os.path.join(SITEMAP_PATH, file_name)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        f.writelines(chunks)
+    os.replace(path + ".part", path)
+    write_precompressed_variants(path)
+
 
+def write_sitemap(prefix: str) -> None:
+    """Write the sitemap index and its shards, without ever holding all urls in memory."""
+    os.makedirs(SITEMAP_PATH, exist_ok=True)
+    entries = generate_sitemap_entries()
+    shard_lastmods = list()
+    shard_lastmod = None
 
-def _insert_url(urlset: eT.Element, prefix: str, loc: str, priority: float) -> None:
-    url = eT.SubElement(urlset, "url")
-    eT.SubElement(url, "loc").text = prefix + loc
-    eT.SubElement(url, "priority").text = str(priority)
+    def track_lastmod(shard_entries: Iterator[tuple]) -> Iterator[tuple]:
+        # Remember the newest lastmod of the shard for the index.
+        nonlocal shard_lastmod
+        for entry in shard_entries:
+            if entry[1] and (shard_lastmod is None or entry[1] > shard_lastmod):
+                shard_lastmod = entry[1]
+            yield entry
+
+    while (first_entry := next(entries, None)) is not None:
+        shard_lastmod = None
+        shard_entries = itertools.chain([first_entry], itertools.islice(entries, MAX_URLS_PER_SITEMAP - 1))
+        shard_file_name = get_sitemap_file_name(len(shard_lastmods) + 1)
+        write_xml_file(shard_file_name, generate_urlset(prefix, track_lastmod(shard_entries)))
+        shard_lastmods.append(shard_lastmod)
+
+    write_xml_file(SITEMAP_INDEX_FILE_NAME, generate_sitemap_index(prefix, shard_lastmods))
+
+    # Remove shards (and their compressed variants) left over from a bigger sitemap.
+    current_file_names = {get_sitemap_file_name(shard) for shard in range(1, len(shard_lastmods) + 1)}
+    for file_name in os.listdir(SITEMAP_PATH):
+        if file_name.startswith("sitemap-") and file_name.split(".xml")[0] + ".xml" not in current_file_names:
+            os.remove(os.path.join(SITEMAP_PATH, file_name))
+
+
+def get_base_url() -> str:
+    return request.base_url.rsplit("/", 1)[0]
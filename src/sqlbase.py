@@ -5,9 +5,15 @@ from abc import abstractmethod
 from datetime import datetime
 from hashlib import sha256
 
-from sqlalchemy import create_engine, Integer, Column, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import create_engine, event, Integer, Column, String, ForeignKey, DateTime, Boolean, Index, \
+    inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, scoped_session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+
+from misc import read_config
 
 Base = declarative_base()
 
@@ -167,14 +173,26 @@ class FileResource(Base, Nameable):
     is_image = Column(Boolean, default=True)
     is_thumbnail = Column(Boolean, default=True)
 
+    # Images are stored in several widths and formats. All of them know the image they were made from, and
+    # only the thumbnail and the full size one are listed, the other variants are just for srcset.
+    is_variant = Column(Boolean, default=False)
+    source_name = Column(String, nullable=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+
     blog_post_id = Column(Integer, ForeignKey("blogposts.id"))
     blog_post = relationship("BlogPost", back_populates="file_resources")
 
     def __init__(self, name: str, clear_name: str, title: str, blog_post: any,
-                 is_image: bool = False, is_thumbnail: bool = False) -> None:
+                 is_image: bool = False, is_thumbnail: bool = False, is_variant: bool = False,
+                 source_name: str = None, width: int = None, height: int = None) -> None:
 
         self.is_thumbnail = is_thumbnail
         self.is_image = is_image
+        self.is_variant = is_variant
+        self.source_name = source_name
+        self.width = width
+        self.height = height
 
         self.clear_name = clear_name
         self.blog_post = blog_post
@@ -210,6 +228,9 @@ class BlogPost(Base, Nameable):
 
     tags = relationship("Tag", secondary="tag_associations", order_by="Tag.name")
 
+    # For the paginated post listings, which walk the visible posts newest first.
+    __table_args__ = (Index("ix_blogposts_listing", "hidden", "timestamp", "id"),)
+
     author_id = Column(Integer, ForeignKey("authors.id"))
     author = relationship("Author", back_populates="blog_posts")
     comments = relationship("Comment", back_populates="blog_post")
@@ -267,10 +288,88 @@ class BlogPost(Base, Nameable):
         return f"BlogPost(id={self.id}, title=\"{self.name}\")"
 
 
-def create_session(path: str) -> any:
-    engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+# Full-text index over the plain text of every compiled post. The rowid is the id of the post.
+SEARCH_TABLE_NAME = "blogpost_search"
+
+
+def create_search_table(engine: any) -> None:
+    engine.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE_NAME} "
+                   f"USING fts5(name, content, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+
+
+def update_search_index(blog_post: BlogPost, plain_text: str) -> None:
+    db.execute(f"DELETE FROM {SEARCH_TABLE_NAME} WHERE rowid = :id", {"id": blog_post.id})
+    db.execute(f"INSERT INTO {SEARCH_TABLE_NAME} (rowid, name, content) VALUES (:id, :name, :content)",
+               {"id": blog_post.id, "name": blog_post.name, "content": plain_text})
+
+
+def rename_in_search_index(flushed_session: any, _flush_context: any) -> None:
+    # The text is only indexed when a post is compiled, but its name has to be found as soon as it is renamed.
+    for instance in flushed_session.dirty:
+        if isinstance(instance, BlogPost) and get_history(instance, "name").has_changes():
+            flushed_session.execute(f"UPDATE {SEARCH_TABLE_NAME} SET name = :name WHERE rowid = :id",
+                                    {"id": instance.id, "name": instance.name})
+
+
+def prune_search_index() -> None:
+    """Remove deleted posts from the search index."""
+    db.execute(f"DELETE FROM {SEARCH_TABLE_NAME} WHERE rowid NOT IN (SELECT id FROM {BlogPost.__tablename__})")
+    db.commit()
+
+
+def set_sqlite_pragmas(connection: any, _connection_record: any) -> None:
+    # WAL lets readers continue while someone writes, and with WAL,
+    # synchronous=NORMAL is still safe against corruption.
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={int(read_config().get('SQLITE_MMAP_SIZE', 0))}")
+    cursor.close()
+
+
+def create_missing_indexes(engine: any) -> None:
+    # create_all skips tables which already exist, including indexes added to them later on.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_names = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_names:
+                index.create(engine)
+
+
+def create_missing_columns(engine: any) -> None:
+    # Same for columns, which are added as nullable ones.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_names = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_names:
+                engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(engine)}")
+
+
+def create_database_engine(path: str) -> any:
+    config = read_config()
+    engine = create_engine("sqlite:///" + path, poolclass=QueuePool,
+                           pool_size=config.get("DATABASE_POOL_SIZE", 5),
+                           max_overflow=config.get("DATABASE_MAX_OVERFLOW", 10),
+                           connect_args={"check_same_thread": False})
+
+    event.listen(engine, "connect", set_sqlite_pragmas)
     Base.metadata.create_all(engine)
-    return sessionmaker(bind=engine)()
+    create_missing_columns(engine)
+    create_missing_indexes(engine)
+    create_search_table(engine)
+    return engine
+
+
+def create_session(engine: any) -> any:
+    # Every thread gets its own session. The Flask app also discards
+    # it at the end of every request (see main.py), the blog manager just keeps using it.
+    return scoped_session(sessionmaker(bind=engine))
+
 
+engine = create_database_engine("blog.db")
+db = create_session(engine)
 
-db = create_session("blog.db")
+# In the same transaction as the rename, so the search index never disagrees with the post.
+event.listen(db, "after_flush", rename_in_search_index)
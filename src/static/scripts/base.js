@@ -61,6 +61,22 @@ function get_password() {
 })();
 
 
+(function load_live_parts() {
+    // Exported post pages are served as files, so the hits and the comment form token come from the app.
+    let hits_span = document.getElementById("live_hits");
+    if (!hits_span)
+        return;
+
+    fetch(hits_span.dataset.url, {credentials: "same-origin"})
+        .then(response => response.json())
+        .then(live_parts => {
+            hits_span.textContent = live_parts.hits;
+            if (csrf_token_field = document.getElementById("csrf_token"))
+                csrf_token_field.value = live_parts.csrf_token;
+        });
+})();
+
+
 (function set_image_onclick() {
     let image_tags = document.getElementsByTagName("img");
     for (image_tag of image_tags) {
@@ -0,0 +1,17 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# The blog modules open their database, read their configuration and build the asset bundles in the
+# working directory, so the tests run in a scratch directory. The app still reads the "config.json" next to it.
+BLOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, BLOG_PATH)
+os.chdir(tempfile.mkdtemp())
+with open("config.json", "w") as f:
+    json.dump({}, f)
+
+shutil.copy(os.path.join(BLOG_PATH, "description.txt"), "description.txt")
+shutil.copytree(os.path.join(BLOG_PATH, "static"), "static", ignore=shutil.ignore_patterns("gen", ".webassets-cache"))
@@ -0,0 +1,54 @@
+from sqlalchemy import event
+
+from main import cache, create_app
+from sqlbase import db, engine, Author, BlogPost, FileResource, Tag
+
+POST_COUNT = 8
+
+
+def add_posts(count: int, authors: list, tags: list) -> None:
+    for _ in range(count):
+        index = db.query(BlogPost).count()
+        blog_post = BlogPost(f"Post {index}", authors[index % len(authors)])
+        blog_post.tags.extend(tags[:index % len(tags) + 1])
+        db.add(blog_post)
+        db.add(FileResource(f"{index}.png", f"image-{index}.png", f"Image {index}", blog_post,
+                            is_image=True, is_thumbnail=True))
+        db.add(FileResource(f"{index}.txt", f"notes-{index}.txt", f"Notes {index}", blog_post))
+    db.commit()
+
+
+def count_statements(client: any, url: str) -> int:
+    statements = list()
+
+    def record_statement(_connection: any, _cursor: any, statement: str, *_args: any) -> None:
+        statements.append(statement)
+
+    # Rendered pages are cached, every page has to be rendered again to be counted.
+    cache.clear()
+    event.listen(engine, "before_cursor_execute", record_statement)
+    try:
+        assert client.get(url).status_code == 200, url
+    finally:
+        event.remove(engine, "before_cursor_execute", record_statement)
+    return len(statements)
+
+
+def test_listing_queries_do_not_grow_with_posts() -> None:
+    client = create_app().test_client()
+    authors = [Author("First Author", ""), Author("Second Author", "")]
+    tags = [Tag("First Tag", "", "", True), Tag("Second Tag", "", "", False)]
+    db.add_all([*authors, *tags])
+    add_posts(POST_COUNT, authors, tags)
+
+    urls = ["/", "/blogposts/", "/files", f"/tags/{tags[0].id}/", f"/authors/{authors[0].id}/"]
+
+    # The first request of each page may set things up, e.g. the form token.
+    for url in urls:
+        client.get(url)
+
+    statement_counts = {url: count_statements(client, url) for url in urls}
+    assert all(statement_counts.values())
+
+    add_posts(POST_COUNT, authors, tags)
+    assert {url: count_statements(client, url) for url in urls} == statement_counts
@@ -0,0 +1,114 @@
+import re
+
+import markdown
+import pytest
+
+import compiler_core
+from compiler_core import get_markdown_renderer, CommonMarkRenderer, PythonMarkdownRenderer, MarkdownIt, \
+    MARKDOWN_EXTENSIONS
+
+# Each one leaves something behind in a Python-Markdown instance, which must not show up in the next post.
+PYTHON_MARKDOWN_POSTS = [
+    """# Footnotes
+
+A claim[^source] and another one[^other].
+
+[^source]: Where the claim comes from.
+[^other]: Somewhere else.
+""",
+    """# Abbreviations
+
+The HTML spec is long, and so is the CSS one.
+
+*[HTML]: Hyper Text Markup Language
+*[CSS]: Cascading Style Sheets
+""",
+    """# Markdown in html
+
+<div class="aside" markdown="1">
+Some *emphasis* in a [block](/aside/).
+</div>
+
+Definition
+:   And its meaning.
+""",
+    """# Nothing special
+
+Mentions HTML and a footnote[^source] without defining either.
+""",
+]
+
+# What both renderers agree on, written the way the posts are.
+COMMON_POSTS = [
+    """# Post
+
+Some *emphasis*, some **strong** text and a [link](/posts/1/post/) to another post.
+A second line in the same paragraph, with `inline code` and an ![image](/static/gen/res/1.png).
+
+## A list
+
+1. First
+2. Second
+3. Third
+
+* Bullet
+* Another bullet
+""",
+    """> A quote, spanning
+> two lines.
+
+```
+def code() -> None:
+    pass
+```
+
+---
+
+| Name | Value |
+| ---- | ----- |
+| a    | 1     |
+""",
+]
+
+WHITESPACE_BETWEEN_TAGS = re.compile(r">\s+<")
+SELF_CLOSING_TAG = re.compile(r"\s*/>")
+OPENING_TAG = re.compile(r"<(\w+)((?:\s+[\w-]+=\"[^\"]*\")+)>")
+ATTRIBUTE = re.compile(r"[\w-]+=\"[^\"]*\"")
+
+
+def sort_attributes(match: any) -> str:
+    return f"<{match.group(1)} {' '.join(sorted(ATTRIBUTE.findall(match.group(2))))}>"
+
+
+def normalize_html(html_src: str) -> str:
+    # Differences which don't change how a page looks, e.g. "<br />" and "<br>" or the order of attributes.
+    html_src = OPENING_TAG.sub(sort_attributes, SELF_CLOSING_TAG.sub(">", html_src))
+    return WHITESPACE_BETWEEN_TAGS.sub("><", html_src).strip()
+
+
+def test_reused_python_markdown_renders_like_a_new_instance() -> None:
+    renderer = PythonMarkdownRenderer()
+
+    # Twice through, so every post follows every other one at least once.
+    for markdown_src in PYTHON_MARKDOWN_POSTS * 2:
+        assert renderer.render(markdown_src) == markdown.markdown(markdown_src, extensions=MARKDOWN_EXTENSIONS)
+
+
+@pytest.mark.skipif(MarkdownIt is None, reason="markdown-it-py is not installed")
+def test_commonmark_renders_the_common_subset_like_python_markdown() -> None:
+    renderer = CommonMarkRenderer()
+    for markdown_src in COMMON_POSTS:
+        assert normalize_html(renderer.render(markdown_src)) == \
+               normalize_html(markdown.markdown(markdown_src, extensions=MARKDOWN_EXTENSIONS))
+
+
+def test_unknown_markdown_renderer_is_a_critical_error(monkeypatch: any, capsys: any) -> None:
+    monkeypatch.setattr(compiler_core, "read_config", lambda: {"MARKDOWN_RENDERER": "unknown"})
+    get_markdown_renderer.cache_clear()
+    try:
+        with pytest.raises(SystemExit):
+            get_markdown_renderer()
+    finally:
+        get_markdown_renderer.cache_clear()
+
+    assert "Unknown Markdown renderer \"unknown\"" in capsys.readouterr().out
@@ -0,0 +1,107 @@
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+import markdown
+
+
+# Measures the per-post cost of every Markdown renderer, their output is checked by the tests.
+# Uses the posts in "blogposts/" next to the blog modules, or a synthetic corpus if there are none.
+
+ROUNDS = 20
+SYNTHETIC_POST_COUNT = 50
+
+SYNTHETIC_POST = """# Post {index}
+
+Some *emphasis*, some **strong** text and a [link](/posts/{index}/post/) to another post.
+A second line in the same paragraph, with `inline code` and an ![image](/static/gen/res/{index}.png).
+
+## A list
+
+1. First
+2. Second with a [reference]({{{{ post: {index} }}}})
+3. Third
+
+* Bullet
+* Another bullet
+
+> A quote, spanning
+> two lines.
+
+```
+def code() -> None:
+    pass
+```
+
+| Name | Value |
+| ---- | ----- |
+| a    | {index} |
+
+<div class="aside">Raw html, left alone.</div>
+
+---
+
+The end of post {index}.
+"""
+
+
+def load_corpus(blog_path: str) -> list:
+    paths = sorted(glob.glob(os.path.join(blog_path, "blogposts", "**", "post.md"), recursive=True))
+    if paths:
+        print(f"Using {len(paths)} posts from \"blogposts/\".")
+        corpus = list()
+        for path in paths:
+            with open(path, "r", encoding="latin-1") as f:
+                corpus.append(f.read().strip())
+        return corpus
+
+    print(f"No posts found, using {SYNTHETIC_POST_COUNT} synthetic ones.")
+    return [SYNTHETIC_POST.format(index=index) for index in range(SYNTHETIC_POST_COUNT)]
+
+
+def measure(render: any, corpus: list) -> float:
+    """Average milliseconds per post."""
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for markdown_src in corpus:
+            render(markdown_src)
+    return (time.perf_counter() - start) * 1000 / (ROUNDS * len(corpus))
+
+
+def main() -> None:
+    print("Flesh-Network Markdown Renderer Benchmark (2021)")
+    print("-> Render posts with every renderer and time them!\n")
+
+    blog_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    sys.path.insert(0, blog_path)
+    corpus = load_corpus(blog_path)
+
+    # The blog modules open a database in the working directory.
+    os.chdir(tempfile.mkdtemp())
+    with open("config.json", "w") as f:
+        json.dump({}, f)
+
+    from compiler_core import MARKDOWN_EXTENSIONS, MARKDOWN_RENDERERS, RESOURCE_PATH_INSERT, MarkdownIt
+
+    # The compiler resolves references before rendering, so the renderers never see them.
+    corpus = [RESOURCE_PATH_INSERT.sub("/reference/", markdown_src) for markdown_src in corpus]
+
+    def render_from_scratch(markdown_src: str) -> str:
+        return markdown.markdown(markdown_src, extensions=MARKDOWN_EXTENSIONS)
+
+    renderers = {"python-markdown (new instance per post)": render_from_scratch}
+    for name, renderer_class in MARKDOWN_RENDERERS.items():
+        if name == "commonmark" and MarkdownIt is None:
+            print("Skipping \"commonmark\", markdown-it-py is not installed.")
+            continue
+        renderers[name] = renderer_class().render
+
+    for name, render in renderers.items():
+        print(f"{name}: {measure(render, corpus):.3f}ms per post")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+# Measures full-text search over a synthetic corpus. Run from anywhere,
+# the blog modules are imported from the parent directory and use a scratch database.
+
+POST_COUNT = 10000
+WORDS_PER_POST = 800
+QUERY_COUNT = 200
+
+
+def make_vocabulary(size: int) -> list:
+    syllables = ["fle", "sch", "net", "work", "geist", "welt", "spi", "rit", "an", "ti", "mon", "no", "my", "ku", "ra"]
+    return list({"".join(random.choices(syllables, k=random.randint(2, 4))) for _ in range(size)})
+
+
+def main() -> None:
+    print("Flesh-Network Search Benchmark (2021)")
+    print(f"-> Index {POST_COUNT} synthetic posts and query them!\n")
+
+    random.seed(1)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    os.chdir(tempfile.mkdtemp())
+    with open("config.json", "w") as f:
+        json.dump({}, f)
+
+    from sqlbase import db, Author, BlogPost, update_search_index
+    from readable_queries import search_visible_blog_posts
+
+    vocabulary = make_vocabulary(20000)
+    author = Author("Benchmark", "")
+    db.add(author)
+    db.add_all(BlogPost(f"Post {i}", author) for i in range(POST_COUNT))
+    db.commit()
+
+    print("Indexing... ", end="", flush=True)
+    start = time.perf_counter()
+    for blog_post in db.query(BlogPost):
+        update_search_index(blog_post, " ".join(random.choices(vocabulary, k=WORDS_PER_POST)))
+    db.commit()
+    print(f"{time.perf_counter() - start:.1f}s")
+
+    for description, make_query in [
+        ("one word", lambda: random.choice(vocabulary)),
+        ("two words", lambda: " ".join(random.choices(vocabulary, k=2))),
+        ("prefix", lambda: random.choice(vocabulary)[:3]),
+    ]:
+        queries = [make_query() for _ in range(QUERY_COUNT)]
+        start = time.perf_counter()
+        result_count = sum(len(search_visible_blog_posts(query, 21, 0)) for query in queries)
+        milliseconds = (time.perf_counter() - start) * 1000 / QUERY_COUNT
+        print(f"Query ({description}): {milliseconds:.2f}ms average, {result_count / QUERY_COUNT:.1f} results")
+
+
+if __name__ == "__main__":
+    main()